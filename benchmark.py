@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import cv2
+import numpy as np
+
+# Benchmark configuration
+SCENARIOS = ('static', 'scroll', 'video', 'switch')
+CODECS = ('jpeg', 'h264', 'vp8')
+STARTUP_TIMEOUT = 10.0  # Seconds to wait for the relay to accept connections
+SHUTDOWN_TIMEOUT = 10.0  # Seconds each process gets to exit and write its statistics
+INPUT_RATE = 10  # Synthetic mouse moves per second sent by the headless controller
+
+
+class SyntheticScreen:
+    """
+    Stand-in for mss that renders one of the benchmark scenarios instead of the real display
+    - static: a desktop with windows and text that never changes
+    - scroll: a text document scrolling a few lines per second
+    - video: a full-motion video playing in a large window
+    - switch: two windows taking turns in front twice a second, like alt-tabbing
+    The pointer drawn by the fake pyautogui is composited on top, so injected input is visible
+    """
+
+    def __init__(self, scenario, width, height):
+        self.scenario = scenario
+        self.width = width
+        self.height = height
+        self.monitors = [{'left': 0, 'top': 0, 'width': width, 'height': height}] * 2
+        self.frame_index = 0
+        self.pointer = None
+
+        self.desktop = np.full((height, width, 4), (120, 90, 60, 255), np.uint8)
+        for i in range(4):
+            x, y = 60 + i * width // 5, 60 + i * height // 8
+            cv2.rectangle(self.desktop, (x, y), (x + width // 3, y + height // 3), (235, 235, 235, 255), -1)
+            cv2.rectangle(self.desktop, (x, y), (x + width // 3, y + 24), (200, 120, 40, 255), -1)
+            for line in range(1, height // 3 // 20):
+                cv2.putText(self.desktop, f"Window {i} line {line} lorem ipsum dolor sit amet", (x + 8, y + 24 + line * 20),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.45, (30, 30, 30, 255), 1)
+
+        # A long document for the scrolling scenario
+        self.document = np.full((height * 3, width, 4), 255, np.uint8)
+        for line in range(height * 3 // 22):
+            cv2.putText(self.document, f"{line:4d}  The quick brown fox jumps over the lazy dog {line * 7919 % 10007}",
+                        (20, 18 + line * 22), cv2.FONT_HERSHEY_SIMPLEX, 0.55, (0, 0, 0, 255), 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def grab(self, monitor):
+        self.frame_index += 1
+        n = self.frame_index
+
+        if self.scenario == 'scroll':
+            offset = (n * 6) % (self.document.shape[0] - self.height)
+            frame = self.document[offset:offset + self.height].copy()
+        else:
+            frame = self.desktop.copy()
+
+        if self.scenario == 'switch' and n // 5 % 2:
+            # The other window comes to the front, covering most of the desktop
+            x0, y0 = self.width // 8, self.height // 8
+            frame[y0:self.height - y0, x0:self.width - x0] = self.document[:self.height - 2 * y0, :self.width - 2 * x0]
+
+        if self.scenario == 'video':
+            # Moving gradients plus grain cover most of the screen, like a playing video
+            x0, y0 = self.width // 10, self.height // 10
+            x1, y1 = self.width - x0, self.height - y0
+            xs = np.arange(x1 - x0, dtype=np.uint16)[None, :]
+            ys = np.arange(y1 - y0, dtype=np.uint16)[:, None]
+            video = frame[y0:y1, x0:x1]
+            video[..., 0] = (xs + n * 5) % 256
+            video[..., 1] = (ys + n * 3) % 256
+            video[..., 2] = ((xs + ys) // 2 + n * 7) % 256
+            video[..., :3] += np.random.randint(0, 16, video[..., :3].shape, np.uint8)
+            cv2.circle(video, ((n * 11) % (x1 - x0), (y1 - y0) // 2), (y1 - y0) // 5, (20, 220, 250, 255), -1)
+
+        if self.pointer is not None:
+            cv2.circle(frame, self.pointer, 6, (0, 0, 0, 255), -1)
+        # Only the requested region, like mss
+        left, top = monitor['left'], monitor['top']
+        return frame[top:top + monitor['height'], left:left + monitor['width']]
+
+
+def install_fakes(scenario, width, height):
+    """Replace mss and pyautogui before controlled.py imports them"""
+    screen = SyntheticScreen(scenario, width, height)
+    # The X11 backends would capture and drive the real display
+    os.environ['CAPTURE_BACKEND'] = 'mss'
+    os.environ['INPUT_BACKEND'] = 'pyautogui'
+
+    fake_mss = types.ModuleType('mss')
+    fake_mss.mss = lambda: screen
+    sys.modules['mss'] = fake_mss
+
+    def move_to(x, y, *args, **kwargs):
+        screen.pointer = (int(x), int(y))
+
+    fake_pyautogui = types.ModuleType('pyautogui')
+    fake_pyautogui.FAILSAFE = False
+    fake_pyautogui.moveTo = move_to
+    for name in ('mouseDown', 'mouseUp', 'keyDown', 'keyUp', 'press', 'click'):
+        setattr(fake_pyautogui, name, lambda *args, **kwargs: None)
+    sys.modules['pyautogui'] = fake_pyautogui
+
+
+def run_controlled(args):
+    install_fakes(args.scenario, args.width, args.height)
+    import controlled
+    controlled.FRAME_RATE = args.fps
+    controlled.main()
+
+
+def run_controller(args):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import controller
+    import threading
+    controller.fullscreen_mode = False
+    controller.original_size = (args.window_width, args.window_height)
+
+    def post_mouse_moves():
+        # Synthetic input so the input round trip is measured as well
+        while True:
+            time.sleep(1.0 / INPUT_RATE)
+            x = random.randrange(controller.original_size[0])
+            y = random.randrange(controller.original_size[1])
+            try:
+                pygame.event.post(pygame.event.Event(pygame.MOUSEMOTION, pos=(x, y), rel=(0, 0), buttons=(0, 0, 0)))
+            except pygame.error:
+                pass  # Display not initialized yet
+
+    threading.Thread(target=post_mouse_moves, daemon=True).start()
+    controller.main()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def wait_with_cpu(process, timeout=SHUTDOWN_TIMEOUT):
+    """Reap a process and return the CPU seconds (user + system) it used, killing it if it hangs"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return usage.ru_utime + usage.ru_stime
+        time.sleep(0.05)
+    print(f"Process {process.args} did not exit, killing it")
+    process.kill()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_case(args, scenario, codec):
+    """Run relay, controlled and controller for one scenario and codec; return the measurements"""
+    stats_dir = tempfile.mkdtemp(prefix='benchmark-')
+    screen_port, input_port = free_port(), free_port()
+    env = dict(os.environ,
+               SERVER_HOST='127.0.0.1', SCREEN_PORT=str(screen_port), INPUT_PORT=str(input_port),
+               SESSION_ID='benchmark', SCREEN_CODEC=codec, STATS_DIR=stats_dir,
+               STATS_WINDOW=str(args.duration + 60), ADAPTIVE_BITRATE='1' if args.adaptive else '0')
+    output = None if args.verbose else subprocess.DEVNULL
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.abspath(__file__)
+    common = ['--scenario', scenario, '--fps', str(args.fps), '--size', f"{args.width}x{args.height}",
+              '--window', f"{args.window_width}x{args.window_height}"]
+
+    relay = subprocess.Popen([sys.executable, 'server.py'], cwd=here, env=env, stdin=subprocess.PIPE,
+                             stdout=output, stderr=output, text=True)
+    if not wait_for_port(screen_port):
+        relay.kill()
+        raise RuntimeError("Relay did not start")
+
+    controller = subprocess.Popen([sys.executable, script, '--role', 'controller'] + common, cwd=here, env=env,
+                                  stdout=output, stderr=output)
+    controlled = subprocess.Popen([sys.executable, script, '--role', 'controlled'] + common, cwd=here, env=env,
+                                  stdout=output, stderr=output)
+
+    time.sleep(args.duration)
+
+    # Stop the source first so the viewer can drain what is still in flight
+    controlled.send_signal(signal.SIGINT)
+    cpu = {'controlled': wait_with_cpu(controlled)}
+    time.sleep(0.5)
+    controller.send_signal(signal.SIGINT)
+    cpu['controller'] = wait_with_cpu(controller)
+    relay.stdin.write('quit\n')
+    relay.stdin.flush()
+    cpu['relay'] = wait_with_cpu(relay)
+
+    results = {}
+    for name in ('controlled', 'relay', 'controller'):
+        try:
+            with open(os.path.join(stats_dir, f"{name}.json")) as f:
+                results[name] = json.load(f)
+        except (OSError, ValueError):
+            results[name] = {'stages': {}, 'totals': {}}
+    shutil.rmtree(stats_dir, ignore_errors=True)
+
+    sent = results['controlled']['totals']
+    shown = results['controller']['totals']
+    stages = results['controller']['stages']
+    return {
+        'scenario': scenario,
+        'codec': codec,
+        'duration': args.duration,
+        'fps': round(shown.get('frames_displayed', 0) / args.duration, 2),
+        'frames_sent': sent.get('frames_sent', 0),
+        'frames_dropped': sent.get('frames_dropped', 0) + results['relay']['totals'].get('frames_dropped', 0),
+        'bytes_per_frame': round(sent.get('bytes_sent', 0) / max(sent.get('frames_sent', 0), 1)),
+        'bytes_per_sec': round(sent.get('bytes_sent', 0) / args.duration),
+        'latency': stages.get('capture_to_display', {}),
+        'input_round_trip': stages.get('input_round_trip', {}),
+        'cpu_percent': {name: round(seconds / args.duration * 100, 1) for name, seconds in cpu.items()},
+        'stats': results,
+    }
+
+
+def print_table(rows):
+    header = (f"{'scenario':<8} {'codec':<5} {'fps':>6} {'bytes/frame':>11} {'KB/s':>8} {'drops':>5} "
+              f"{'lat p50':>8} {'p95':>7} {'p99':>7} {'input p50':>9} "
+              f"{'cpu ctl%':>8} {'relay%':>6} {'view%':>6}")
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        latency, round_trip, cpu = row['latency'], row['input_round_trip'], row['cpu_percent']
+        print(f"{row['scenario']:<8} {row['codec']:<5} {row['fps']:>6} {row['bytes_per_frame']:>11} "
+              f"{row['bytes_per_sec'] / 1024:>8.1f} {row['frames_dropped']:>5} "
+              f"{str(latency.get('p50_ms')):>8} {str(latency.get('p95_ms')):>7} {str(latency.get('p99_ms')):>7} "
+              f"{str(round_trip.get('p50_ms')):>9} "
+              f"{cpu['controlled']:>8} {cpu['relay']:>6} {cpu['controller']:>6}")
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run controlled -> relay -> controller over loopback with synthetic screens "
+                    "and report FPS, latency, bytes per frame and CPU per process")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per case")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma separated, from: " + ' '.join(SCENARIOS))
+    parser.add_argument('--codecs', default='jpeg', help="comma separated, from: " + ' '.join(CODECS))
+    parser.add_argument('--fps', type=int, default=30, help="capture frame rate")
+    parser.add_argument('--size', default='1920x1080', help="synthetic screen size")
+    parser.add_argument('--window', default='1280x720', help="controller window size")
+    parser.add_argument('--adaptive', action='store_true', help="keep adaptive bitrate enabled")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="show the output of every process")
+    parser.add_argument('--role', choices=('controlled', 'controller'), help=argparse.SUPPRESS)
+    parser.add_argument('--scenario', default='static', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.width, args.height = parse_size(args.size)
+    args.window_width, args.window_height = parse_size(args.window)
+
+    if args.role == 'controlled':
+        return run_controlled(args)
+    if args.role == 'controller':
+        return run_controller(args)
+
+    rows = []
+    for scenario in args.scenarios.split(','):
+        for codec in args.codecs.split(','):
+            print(f"Running {scenario} with {codec} for {args.duration:g}s...")
+            rows.append(run_case(args, scenario, codec))
+
+    print()
+    print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,476 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+
+import mss
+import numpy as np
+
+# Capture configuration - configurable via environment variables
+# 'auto' tries xdamage, then xshm, then mss; 'fake' renders a synthetic desktop for tests
+CAPTURE_BACKEND = os.getenv('CAPTURE_BACKEND', 'auto')
+
+# Xlib constants
+Z_PIXMAP = 2
+ALL_PLANES = 0xFFFFFFFFFFFFFFFF
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+X_DAMAGE_REPORT_NON_EMPTY = 3  # One event when the damage goes from empty to non-empty
+X_EVENT_SIZE = 24 * 8  # sizeof(XEvent) on 64-bit platforms, with room to spare on 32-bit ones
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [('shmseg', ctypes.c_ulong), ('shmid', ctypes.c_int),
+                ('shmaddr', ctypes.c_void_p), ('readOnly', ctypes.c_int)]
+
+
+class XImage(ctypes.Structure):
+    # Leading fields only, the image is always created and freed by Xlib
+    _fields_ = [('width', ctypes.c_int), ('height', ctypes.c_int), ('xoffset', ctypes.c_int),
+                ('format', ctypes.c_int), ('data', ctypes.c_void_p), ('byte_order', ctypes.c_int),
+                ('bitmap_unit', ctypes.c_int), ('bitmap_bit_order', ctypes.c_int), ('bitmap_pad', ctypes.c_int),
+                ('depth', ctypes.c_int), ('bytes_per_line', ctypes.c_int), ('bits_per_pixel', ctypes.c_int)]
+
+
+class XRectangle(ctypes.Structure):
+    _fields_ = [('x', ctypes.c_short), ('y', ctypes.c_short),
+                ('width', ctypes.c_ushort), ('height', ctypes.c_ushort)]
+
+
+class XFixesCursorImage(ctypes.Structure):
+    _fields_ = [('x', ctypes.c_short), ('y', ctypes.c_short), ('width', ctypes.c_ushort),
+                ('height', ctypes.c_ushort), ('xhot', ctypes.c_ushort), ('yhot', ctypes.c_ushort),
+                ('cursor_serial', ctypes.c_ulong), ('pixels', ctypes.POINTER(ctypes.c_ulong))]
+
+
+X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+
+class CaptureBackend:
+    """
+    Grabs a region of the desktop as a BGRA array
+    grab() returns (frame, damage): damage lists the (x, y, width, height) rectangles of the
+    region that may have changed since the previous grab, or is None when the backend cannot
+    tell. The frame may share memory with the backend and is only valid until the next grab.
+    wait() blocks until the screen may have changed; polling backends return immediately.
+    cursor() may be called from another thread than grab().
+    """
+
+    name = None
+    monitors = []  # mss monitor list: the whole desktop first, then each monitor
+
+    def wait(self, timeout):
+        return True
+
+    def grab(self, region):
+        raise NotImplementedError
+
+    def cursor(self):
+        """
+        Return (x, y, shape) of the pointer in desktop coordinates, or None if it is unknown
+        shape is (shape ID, hotspot x, hotspot y, BGRA array), or None if only the position is known
+        """
+        return None
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MssCapture(CaptureBackend):
+    """Portable polling capture; the pixels are wrapped in place instead of copied"""
+
+    name = 'mss'
+
+    def __init__(self):
+        self.sct = mss.mss()
+        self.monitors = self.sct.monitors
+        self.pyautogui = None
+
+    def grab(self, region):
+        # asarray goes through the screenshot's array interface, np.array would copy every frame
+        return np.asarray(self.sct.grab(region)), None
+
+    def cursor(self):
+        # mss cannot read the pointer; pyautogui at least knows where it is
+        if self.pyautogui is None:
+            try:
+                import pyautogui
+                self.pyautogui = pyautogui
+            except Exception:
+                self.pyautogui = False
+        if not self.pyautogui:
+            return None
+        try:
+            x, y = self.pyautogui.position()
+        except Exception:
+            return None
+        return x, y, None
+
+    def close(self):
+        self.sct.close()
+
+
+def load_library(name):
+    path = ctypes.util.find_library(name)
+    if path is None:
+        raise OSError(f"lib{name} not found")
+    return ctypes.CDLL(path)
+
+
+class XShmCapture(CaptureBackend):
+    """
+    X11 capture through the MIT-SHM extension: the X server writes each frame straight into a
+    shared memory segment that is reused for every grab of the same size
+    """
+
+    name = 'xshm'
+
+    def __init__(self):
+        self.x11 = load_library('X11')
+        self.xext = load_library('Xext')
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.declare_functions()
+        self.image = self.shminfo = self.frame = None
+        self.lock = threading.RLock()  # The display connection is shared with the cursor thread
+        self.cursor_shape = None
+
+        self.display = self.x11.XOpenDisplay(None)
+        if not self.display:
+            raise OSError("cannot open the X display")
+        # The default handler exits the process on any X error, e.g. MIT-SHM over a remote display
+        self.x_error = None
+        self.error_handler = X_ERROR_HANDLER(self.on_x_error)
+        self.x11.XSetErrorHandler(self.error_handler)
+        if not self.xext.XShmQueryExtension(self.display):
+            self.x11.XCloseDisplay(self.display)
+            raise OSError("the X server has no MIT-SHM extension")
+        self.root = self.x11.XDefaultRootWindow(self.display)
+        self.xfixes = self.open_xfixes()
+
+        # The X server numbers monitors the same way
+        with mss.mss() as sct:
+            self.monitors = sct.monitors
+
+    def declare_functions(self):
+        x11, xext, libc = self.x11, self.xext, self.libc
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        x11.XSetErrorHandler.restype = ctypes.c_void_p
+        x11.XSetErrorHandler.argtypes = [X_ERROR_HANDLER]
+        x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        x11.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        x11.XDefaultVisual.restype = ctypes.c_void_p
+        x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XFree.argtypes = [ctypes.c_void_p]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_char_p, ctypes.POINTER(XShmSegmentInfo),
+                                         ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage),
+                                      ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    def open_xfixes(self):
+        """XFIXES provides the cursor image and damage regions; None if the server lacks it"""
+        try:
+            xfixes = load_library('Xfixes')
+        except OSError:
+            return None
+        xfixes.XFixesQueryExtension.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        xfixes.XFixesQueryVersion.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        xfixes.XFixesCreateRegion.restype = ctypes.c_ulong
+        xfixes.XFixesCreateRegion.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]
+        xfixes.XFixesDestroyRegion.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        xfixes.XFixesFetchRegion.restype = ctypes.POINTER(XRectangle)
+        xfixes.XFixesFetchRegion.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(ctypes.c_int)]
+        xfixes.XFixesGetCursorImage.restype = ctypes.POINTER(XFixesCursorImage)
+        xfixes.XFixesGetCursorImage.argtypes = [ctypes.c_void_p]
+        event_base, error_base = ctypes.c_int(), ctypes.c_int()
+        if not xfixes.XFixesQueryExtension(self.display, ctypes.byref(event_base), ctypes.byref(error_base)):
+            return None
+        # The client has to announce its version before any other request
+        major, minor = ctypes.c_int(), ctypes.c_int()
+        xfixes.XFixesQueryVersion(self.display, ctypes.byref(major), ctypes.byref(minor))
+        return xfixes
+
+    def on_x_error(self, display, event):
+        self.x_error = True
+        return 0
+
+    def check_x_error(self, action):
+        self.x11.XSync(self.display, 0)
+        if self.x_error:
+            self.x_error = None
+            raise OSError(f"X error while {action}")
+
+    def create_image(self, width, height):
+        """Allocate a shared memory image of the given size, replacing the previous one"""
+        self.destroy_image()
+        screen = self.x11.XDefaultScreen(self.display)
+        shminfo = XShmSegmentInfo()
+        image = self.xext.XShmCreateImage(self.display, self.x11.XDefaultVisual(self.display, screen),
+                                          self.x11.XDefaultDepth(self.display, screen), Z_PIXMAP, None,
+                                          ctypes.byref(shminfo), width, height)
+        if not image:
+            raise OSError("XShmCreateImage failed")
+        bits_per_pixel = image.contents.bits_per_pixel
+        if bits_per_pixel != 32:
+            self.x11.XFree(image)
+            raise OSError(f"unsupported {bits_per_pixel}-bit X visual")
+
+        size = image.contents.bytes_per_line * height
+        shminfo.shmid = self.libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            self.x11.XFree(image)
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        shminfo.shmaddr = self.libc.shmat(shminfo.shmid, None, 0)
+        # The segment goes away once both sides detach, even if this process dies
+        self.libc.shmctl(shminfo.shmid, IPC_RMID, None)
+        if shminfo.shmaddr in (None, ctypes.c_void_p(-1).value):
+            self.x11.XFree(image)
+            raise OSError(ctypes.get_errno(), "shmat failed")
+        image.contents.data = shminfo.shmaddr
+        shminfo.readOnly = 0
+        self.image, self.shminfo = image, shminfo
+
+        self.xext.XShmAttach(self.display, ctypes.byref(shminfo))
+        self.check_x_error("attaching shared memory")
+
+        stride = image.contents.bytes_per_line // 4
+        buffer = (ctypes.c_uint8 * size).from_address(shminfo.shmaddr)
+        self.frame = np.frombuffer(buffer, np.uint8).reshape(height, stride, 4)[:, :width]
+
+    def destroy_image(self):
+        if self.image is None:
+            return
+        self.xext.XShmDetach(self.display, ctypes.byref(self.shminfo))
+        self.x11.XSync(self.display, 0)
+        self.libc.shmdt(self.shminfo.shmaddr)
+        self.image.contents.data = None
+        self.x11.XFree(self.image)
+        self.image = self.shminfo = self.frame = None
+
+    def grab(self, region):
+        width, height = region['width'], region['height']
+        with self.lock:
+            if self.image is None or (self.image.contents.width, self.image.contents.height) != (width, height):
+                self.create_image(width, height)
+            if not self.xext.XShmGetImage(self.display, self.root, self.image, region['left'], region['top'],
+                                          ALL_PLANES):
+                raise OSError("XShmGetImage failed")
+        return self.frame, None
+
+    def cursor(self):
+        if self.xfixes is None:
+            return None
+        with self.lock:
+            if not self.display:
+                return None
+            image = self.xfixes.XFixesGetCursorImage(self.display)
+            if not image:
+                return None
+            try:
+                c = image.contents
+                if self.cursor_shape is None or self.cursor_shape[0] != c.cursor_serial & 0xFFFFFFFF:
+                    # Premultiplied ARGB in the low 32 bits of each unsigned long, which is BGRA in memory
+                    pixels = np.ctypeslib.as_array(c.pixels, shape=(c.height * c.width,)).astype(np.uint32)
+                    bgra = pixels.view(np.uint8).reshape(c.height, c.width, 4).astype(np.float32)
+                    alpha = bgra[:, :, 3:]
+                    bgra[:, :, :3] = np.where(alpha > 0, bgra[:, :, :3] * 255 / np.maximum(alpha, 1), 0)
+                    self.cursor_shape = (c.cursor_serial & 0xFFFFFFFF, c.xhot, c.yhot,
+                                         np.clip(bgra, 0, 255).astype(np.uint8))
+                x, y = c.x, c.y
+            finally:
+                self.x11.XFree(image)
+        return x, y, self.cursor_shape
+
+    def close(self):
+        with self.lock:
+            if self.display:
+                self.destroy_image()
+                self.x11.XCloseDisplay(self.display)
+                self.display = None
+
+
+class XDamageCapture(XShmCapture):
+    """
+    XShmCapture that asks the X server which areas changed: wait() sleeps on the X connection
+    until something is drawn, and grab() reports the damaged rectangles so change detection
+    only has to look there
+    """
+
+    name = 'xdamage'
+
+    def __init__(self):
+        super().__init__()
+        try:
+            if self.xfixes is None:
+                raise OSError("the X server has no XFIXES extension")
+            self.xdamage = load_library('Xdamage')
+            self.declare_damage_functions()
+            event_base, error_base = ctypes.c_int(), ctypes.c_int()
+            if not self.xdamage.XDamageQueryExtension(self.display, ctypes.byref(event_base),
+                                                      ctypes.byref(error_base)):
+                raise OSError("the X server has no DAMAGE extension")
+            # The client has to announce its version before any other request
+            major, minor = ctypes.c_int(), ctypes.c_int()
+            self.xdamage.XDamageQueryVersion(self.display, ctypes.byref(major), ctypes.byref(minor))
+        except OSError:
+            super().close()
+            raise
+        self.damage = self.xdamage.XDamageCreate(self.display, self.root, X_DAMAGE_REPORT_NON_EMPTY)
+        self.parts = self.xfixes.XFixesCreateRegion(self.display, None, 0)
+        self.check_x_error("creating the damage object")
+        self.fd = self.x11.XConnectionNumber(self.display)
+        self.event = ctypes.create_string_buffer(X_EVENT_SIZE)
+        self.last_region = None
+
+    def declare_damage_functions(self):
+        x11, xdamage = self.x11, self.xdamage
+        x11.XConnectionNumber.argtypes = [ctypes.c_void_p]
+        x11.XPending.argtypes = [ctypes.c_void_p]
+        x11.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        x11.XFlush.argtypes = [ctypes.c_void_p]
+        xdamage.XDamageQueryExtension.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        xdamage.XDamageQueryVersion.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        xdamage.XDamageCreate.restype = ctypes.c_ulong
+        xdamage.XDamageCreate.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int]
+        xdamage.XDamageDestroy.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        xdamage.XDamageSubtract.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_ulong]
+
+    def drain_events(self):
+        """Discard queued damage notifications; returns True if there were any"""
+        pending = False
+        while self.x11.XPending(self.display):
+            self.x11.XNextEvent(self.display, self.event)
+            pending = True
+        return pending
+
+    def wait(self, timeout):
+        with self.lock:
+            if self.drain_events():
+                return True
+        select.select([self.fd], [], [], timeout)
+        with self.lock:
+            return self.drain_events()
+
+    def grab(self, region):
+        with self.lock:
+            self.drain_events()
+            # Take the damage before grabbing, so anything drawn during the grab is reported next time
+            self.xdamage.XDamageSubtract(self.display, self.damage, 0, self.parts)
+            count = ctypes.c_int()
+            rects = self.xfixes.XFixesFetchRegion(self.display, self.parts, ctypes.byref(count))
+            damage = []
+            try:
+                for i in range(count.value):
+                    rect = rects[i]
+                    # Root window coordinates, clipped to the region being captured
+                    x0 = max(rect.x - region['left'], 0)
+                    y0 = max(rect.y - region['top'], 0)
+                    x1 = min(rect.x + rect.width - region['left'], region['width'])
+                    y1 = min(rect.y + rect.height - region['top'], region['height'])
+                    if x1 > x0 and y1 > y0:
+                        damage.append((x0, y0, x1 - x0, y1 - y0))
+            finally:
+                if rects:
+                    self.x11.XFree(rects)
+
+            frame, _ = super().grab(region)
+        if region != self.last_region:
+            # Damage is relative to the previous grab, which showed a different area
+            self.last_region = dict(region)
+            damage = None
+        return frame, damage
+
+    def close(self):
+        with self.lock:
+            if self.display:
+                self.xdamage.XDamageDestroy(self.display, self.damage)
+                self.xfixes.XFixesDestroyRegion(self.display, self.parts)
+            super().close()
+
+
+class FakeCapture(CaptureBackend):
+    """
+    Synthetic desktop for tests: a still image that only changes when paint() is called, with
+    exact damage reporting, so the damage-driven paths run without a display
+    """
+
+    name = 'fake'
+
+    def __init__(self, width=1280, height=720):
+        self.monitors = [{'left': 0, 'top': 0, 'width': width, 'height': height},
+                         {'left': 0, 'top': 0, 'width': width, 'height': height}]
+        self.screen = np.full((height, width, 4), (120, 90, 60, 255), np.uint8)
+        self.damage = []
+        self.changed = threading.Event()
+        self.lock = threading.Lock()
+        self.pointer = (width // 2, height // 2)
+
+    def move_pointer(self, x, y):
+        """Move the pointer; like a hardware cursor it does not damage the desktop"""
+        self.pointer = (x, y)
+
+    def cursor(self):
+        x, y = self.pointer
+        return x, y, None
+
+    def paint(self, x, y, width, height, color=(255, 255, 255)):
+        """Fill a rectangle of the desktop, as an application drawing would"""
+        with self.lock:
+            self.screen[y:y + height, x:x + width, :3] = color
+            self.damage.append((x, y, width, height))
+        self.changed.set()
+
+    def wait(self, timeout):
+        return self.changed.wait(timeout)
+
+    def grab(self, region):
+        left, top, width, height = region['left'], region['top'], region['width'], region['height']
+        with self.lock:
+            self.changed.clear()
+            frame = self.screen[top:top + height, left:left + width].copy()
+            damage = []
+            for x, y, w, h in self.damage:
+                x0, y0 = max(x - left, 0), max(y - top, 0)
+                x1, y1 = min(x + w - left, width), min(y + h - top, height)
+                if x1 > x0 and y1 > y0:
+                    damage.append((x0, y0, x1 - x0, y1 - y0))
+            self.damage = []
+        return frame, damage
+
+
+BACKENDS = {'mss': MssCapture, 'xshm': XShmCapture, 'xdamage': XDamageCapture, 'fake': FakeCapture}
+
+
+def open_backend(name=CAPTURE_BACKEND):
+    """Open the named capture backend; 'auto' picks the fastest one that works on this machine"""
+    if name != 'auto':
+        return BACKENDS[name]()
+    candidates = ['xdamage', 'xshm'] if os.getenv('DISPLAY') else []
+    for candidate in candidates:
+        try:
+            return BACKENDS[candidate]()
+        except (OSError, AttributeError) as e:
+            print(f"{candidate} capture unavailable: {e}")
+    return MssCapture()
@@ -13,6 +13,8 @@ from tkinter.font import Font
 SERVER_HOST = os.getenv('SERVER_HOST', '192.168.0.188')
 SCREEN_PORT = int(os.getenv('SCREEN_PORT', '12345'))
 INPUT_PORT = int(os.getenv('INPUT_PORT', '12346'))
+SESSION_ID = os.getenv('SESSION_ID', 'default')
+SCREEN_CODEC = os.getenv('SCREEN_CODEC', 'jpeg')
 
 
 class RemoteControlApp:
@@ -76,12 +78,21 @@ class RemoteControlApp:
                                     wraplength=400)
         controlled_desc.pack(pady=(10, 0))
 
+        # Screen codec used when this computer is controlled
+        codec_frame = ttk.Frame(self.main_frame)
+        codec_frame.pack(pady=(10, 0))
+        ttk.Label(codec_frame, text="Screen codec:").pack(side=tk.LEFT, padx=(0, 10))
+        self.codec_var = tk.StringVar(value=SCREEN_CODEC)
+        codec_box = ttk.Combobox(codec_frame, textvariable=self.codec_var, values=("jpeg", "h264", "vp8"),
+                                 state="readonly", width=8)
+        codec_box.pack(side=tk.LEFT)
+
         # Server info
         server_frame = ttk.Frame(self.main_frame)
         server_frame.pack(side=tk.BOTTOM, pady=20, fill=tk.X)
 
         server_label = ttk.Label(server_frame,
-                                 text=f"Server: {SERVER_HOST}:{SCREEN_PORT}/{INPUT_PORT}",
+                                 text=f"Server: {SERVER_HOST}:{SCREEN_PORT}/{INPUT_PORT}  Session: {SESSION_ID}",
                                  font=("Arial", 10))
         server_label.pack()
 
@@ -101,10 +112,12 @@ class RemoteControlApp:
             messagebox.showerror("Error", f"An unexpected error occurred: {e}")
 
     def start_controlled(self):
+        codec = self.codec_var.get()
         self.root.destroy()  # Close the UI
         try:
             print("Starting as Controlled...")
             import controlled
+            controlled.SCREEN_CODEC = codec
             controlled.main()
         except ModuleNotFoundError:
             messagebox.showerror("Error",
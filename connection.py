@@ -0,0 +1,100 @@
+import os
+import socket
+import struct
+
+# Socket tuning - configurable via environment variables
+SCREEN_BITRATE = int(os.getenv('SCREEN_BITRATE', str(20 * 1000 * 1000)))  # Target screen stream bits per second
+SCREEN_BUFFER_TIME = float(os.getenv('SCREEN_BUFFER_TIME', '0.05'))  # Seconds of screen data the send buffer holds
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+KEEPALIVE_IDLE = 10  # Seconds of silence before the first keepalive probe
+KEEPALIVE_INTERVAL = 5  # Seconds between probes
+KEEPALIVE_COUNT = 3  # Unanswered probes before the connection is considered dead
+
+# Type of service per channel: input asks for low delay, the screen stream for throughput
+CHANNEL_TOS = {'input': 0x10, 'screen': 0x08}
+CHANNEL_PRIORITY = {'input': 6, 'screen': 0}  # Linux SO_PRIORITY, higher is sent first by the qdisc
+
+
+def screen_buffer_size(bitrate=SCREEN_BITRATE, buffer_time=SCREEN_BUFFER_TIME):
+    """Socket buffer size for the screen channel: the bytes sent at the target bitrate in buffer_time"""
+    return int(min(max(bitrate / 8 * buffer_time, MIN_BUFFER_SIZE), MAX_BUFFER_SIZE))
+
+
+def enable_keepalive(sock):
+    """Detect dead peers (e.g. a laptop that went to sleep) instead of waiting forever"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS only has the idle time
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, KEEPALIVE_IDLE)
+    elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows takes milliseconds; sockets wrapped by asyncio do not expose ioctl
+        try:
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+        except (AttributeError, OSError):
+            pass
+
+
+def configure_socket(sock, channel):
+    """
+    Apply the options for a 'screen' or 'input' connection
+    Every message is written with a single call, so Nagle's algorithm only ever delays the tail of
+    a message waiting for a delayed ACK; it is disabled on both channels. The screen send buffer
+    is sized from the target bitrate so frames do not queue in the kernel; the receive buffer is
+    left to autotuning, since pinning it would cap throughput at buffer size / RTT.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    enable_keepalive(sock)
+
+    if channel == 'screen':
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, screen_buffer_size())
+
+    # Priority hints are best effort: routers may ignore them and some platforms refuse them
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, CHANNEL_TOS[channel])
+    except (AttributeError, OSError):
+        pass
+    if hasattr(socket, 'SO_PRIORITY'):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, CHANNEL_PRIORITY[channel])
+        except OSError:
+            pass
+
+
+def create_socket(channel):
+    """Create a TCP socket configured for the 'screen' or 'input' channel, ready to connect"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    configure_socket(sock, channel)
+    return sock
+
+
+def create_datagram_socket():
+    """Create a UDP socket for the datagram screen transport"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    configure_datagram_socket(sock)
+    return sock
+
+
+def configure_datagram_socket(sock):
+    # A keyframe is sent as a burst of fragments, the buffers must hold all of them
+    size = screen_buffer_size()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, CHANNEL_TOS['screen'])
+    except (AttributeError, OSError):
+        pass
+
+
+def get_send_backlog(sock):
+    """Return the number of bytes still queued in the kernel send buffer, or None if unsupported"""
+    try:
+        import fcntl
+        import termios
+        return struct.unpack("I", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0' * 4))[0]
+    except (ImportError, AttributeError, OSError):
+        return None
@@ -1,132 +1,521 @@
-import socket
-import mss
+import collections
 import cv2
+import logging
 import numpy as np
-import struct
 import time
 import threading
-import json
 import os
 import sys
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 from threading import Event, Thread
 
-# For actual keyboard and mouse control
-import pyautogui
+try:
+    import av  # Optional: PyAV, only needed for the video codec screen modes
+except ImportError:
+    av = None
+
+import capture
+import injection
+import protocol
+import stats
+from connection import create_socket, get_send_backlog
+from datagram import DatagramLink
+from framing import FrameReader, send_message
+from protocol import sendmsg
+from tilecache import TileCache, whole_tiles
 
 # Server address - configurable via environment variables
 SERVER_HOST = os.getenv('SERVER_HOST', '192.168.0.188')
 SCREEN_PORT = int(os.getenv('SCREEN_PORT', '12345'))
 INPUT_PORT = int(os.getenv('INPUT_PORT', '12346'))
+SESSION_ID = os.getenv('SESSION_ID', 'default')  # Pairs this client with its peer on a shared server
+SCREEN_TRANSPORT = os.getenv('SCREEN_TRANSPORT', 'tcp')  # 'udp' sends screen frames as datagrams
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # DEBUG logs every injected key and mouse event
+CAPTURE_MONITOR = int(os.getenv('CAPTURE_MONITOR', '0'))  # 0 is the whole desktop, 1 and up single monitors
 
 # Configuration
 QUALITY = 60  # JPEG quality
 SCALE_FACTOR = 1.0  # Scale factor for screen capture
 FRAME_RATE = 10  # Target frames per second
+TILE_SIZE = 64  # Tile edge in pixels for change detection
+KEYFRAME_INTERVAL = 5.0  # Seconds between full-frame refreshes
+FULL_FRAME_RATIO = 0.5  # Send a full frame when more than this share of the screen changed
+MIN_REGION_SIZE = 64  # Smallest capture region edge in pixels
+IDLE_WAIT = 0.1  # Longest sleep waiting for screen damage, bounds the delay of keyframe requests
+CURSOR_RATE = int(os.getenv('CURSOR_RATE', '60'))  # Pointer polls per second, independent of FRAME_RATE
 
-# Initialize pyautogui safely
-pyautogui.FAILSAFE = False  # Disable fail-safe (move mouse to corner to abort)
+# Screen encoding: 'jpeg' tiles, or a streaming video codec that also compresses between frames
+SCREEN_CODEC = os.getenv('SCREEN_CODEC', 'jpeg')
+VIDEO_CODECS = {'h264': 'libx264', 'vp8': 'libvpx'}  # Screen codec -> software encoder
+VIDEO_OPTIONS = {
+    'h264': {'preset': 'ultrafast', 'tune': 'zerolatency'},
+    'vp8': {'deadline': 'realtime', 'cpu-used': '8', 'lag-in-frames': '0', 'b': '8M'},
+}
 
+# Pipeline configuration
+CAPTURE_QUEUE_SIZE = 2  # Raw frames waiting for encoding
+SEND_QUEUE_SIZE = 3  # Encoded frames waiting for the socket
+ENCODE_WORKERS = int(os.getenv('ENCODE_WORKERS', str(os.cpu_count() or 2)))
+STRIPE_HEIGHT = 256  # Taller rectangles are split into stripes of this height, a multiple of TILE_SIZE
+PARALLEL_ENCODE_AREA = 512 * 512  # Frames with fewer changed pixels are encoded on a single thread
+SCROLL_DETECTION = os.getenv('SCROLL_DETECTION', '1') == '1'  # Send scrolled content as a copy, tile mode only
+SCROLL_DETECT_RATIO = 0.25  # Look for scrolling when more than this share of the screen changed
+MIN_SCROLL_LINES = 8  # Rows or columns that must agree on a shift before it is tried
+TILE_CACHE_MB = float(os.getenv('TILE_CACHE_MB', '64'))  # Viewer memory for recently sent tiles, 0 disables
+TILE_CACHE_TILES = int(TILE_CACHE_MB * 1024 * 1024 // (TILE_SIZE * TILE_SIZE * 3))
 
-def sendmsg(socket, key_data):
-    data = json.dumps(key_data).encode()
-    size = len(data)
-    socket.sendall(struct.pack(">L", size) + data)
+# Adaptive bitrate: trade quality, frame rate and resolution for latency on slow links
+ADAPTIVE_BITRATE = os.getenv('ADAPTIVE_BITRATE', '1') == '1'
+TARGET_LATENCY_MS = int(os.getenv('TARGET_LATENCY_MS', '150'))  # Capture to viewer acknowledgement
+ADAPT_INTERVAL = 0.5  # Seconds between adjustments
+MIN_QUALITY = 25
+MIN_SCALE_FACTOR = 0.4
+MIN_FRAME_RATE = 2
+MAX_SEND_BACKLOG = 256 * 1024  # Unsent bytes in the kernel buffer that count as congestion
 
+log = logging.getLogger('controlled')
+pipeline_stats = stats.Stats('controlled')
+input_backend = None  # Injects keyboard and mouse events, opened in main
+# Encodes the stripes of one frame in parallel; separate from the frame pool, whose workers wait on it
+stripe_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+inputs_applied = 0  # Input records handled on this input connection, stamped on frames to measure input round trips
+datagram_link = None  # UDP path for screen frames, once the relay has accepted it
+tile_cache = TileCache(TILE_CACHE_TILES)  # Hashes of the tiles the viewer has cached, used by the encode stage
+monitors = []  # mss monitor list: the whole desktop first, then each monitor
+capture_region = None  # Desktop area being captured: mss monitor dict with left, top, width and height
+screen_info = None  # Latest screen_info message, describing the codec and the capture region
+viewer_size = None  # (width, height) the viewers can show, frames are never encoded larger
+screen_send_lock = threading.Lock()  # Frames and control replies share the screen socket
 
-def recvmsg(socket):
-    size_data = recvall(socket, 4)
-    if not size_data:
-        return None
-    size = struct.unpack(">L", size_data)[0]
-    data = recvall(socket, size)
-    if data is None:
-        return None
-    try:
-        key_data = json.loads(data.decode())
-        return key_data
-    except:
-        return None
 
+def find_dirty_rects(prev_frame, frame, tile_size=TILE_SIZE, damage=None):
+    """
+    Compare two frames tile by tile and return the changed areas
+    Adjacent changed tiles in a row are merged into one (x, y, width, height) rectangle
+    With damage rectangles from the capture backend, only those areas are compared
+    """
+    height, width = frame.shape[:2]
+    rows = -(-height // tile_size)
+    cols = -(-width // tile_size)
+
+    # Per-pixel change mask, padded to whole tiles and reduced to one flag per tile
+    changed = np.zeros((rows * tile_size, cols * tile_size), dtype=bool)
+    if damage is None:
+        changed[:height, :width] = np.any(prev_frame != frame, axis=2)
+    else:
+        for x, y, w, h in damage:
+            x1, y1 = min(x + w, width), min(y + h, height)
+            changed[y:y1, x:x1] = np.any(prev_frame[y:y1, x:x1] != frame[y:y1, x:x1], axis=2)
+    tiles = changed.reshape(rows, tile_size, cols, tile_size).any(axis=(1, 3))
+
+    rects = []
+    for row in range(rows):
+        changed_cols = np.flatnonzero(tiles[row])
+        if len(changed_cols) == 0:
+            continue
+        y = row * tile_size
+        h = min(y + tile_size, height) - y
+        breaks = np.flatnonzero(np.diff(changed_cols) > 1) + 1
+        for run in np.split(changed_cols, breaks):
+            x = int(run[0]) * tile_size
+            w = min((int(run[-1]) + 1) * tile_size, width) - x
+            rects.append((x, y, w, h))
+    return rects
+
+
+def line_hashes(block):
+    """Hash of every row of an image block"""
+    return [hash(row.tobytes()) for row in block]
+
+
+def find_shift(prev_lines, lines):
+    """
+    Return the offset d for which lines[i] == prev_lines[i + d] holds most often, and how often
+    Lines found more than once in the previous frame (blank lines, flat backgrounds) could
+    match at any offset, so they do not vote
+    """
+    positions = {}
+    for index, line in enumerate(prev_lines):
+        positions[line] = None if line in positions else index
+    votes = collections.Counter(positions[line] - index for index, line in enumerate(lines)
+                                if positions.get(line) is not None)
+    votes.pop(0, None)
+    return votes.most_common(1)[0] if votes else (0, 0)
+
+
+def shifted_changes(prev_lines, lines, shift):
+    """
+    Return where the lines moving by shift land, and the runs of (start, length) lines that
+    still differ once they have moved, the newly exposed ones included
+    """
+    start = max(-shift, 0)
+    end = len(lines) - max(shift, 0)
+    changed = np.array([not (start <= index < end and line == prev_lines[index + shift])
+                        for index, line in enumerate(lines)])
+    indices = np.flatnonzero(changed)
+    runs = np.split(indices, np.flatnonzero(np.diff(indices) > 1) + 1) if len(indices) else []
+    return (start, end - start), [(int(run[0]), len(run)) for run in runs]
+
+
+def detect_scroll(prev_frame, frame, rects):
+    """
+    Look for content that moved vertically, or else horizontally, within the changed area
+    Returns (copy rectangle as x, y, width, height, source x, source y, rectangles still to send)
+    or None; the line hashes tell which lines still differ, so the frame is not compared again
+    """
+    x0, y0 = min(x for x, _, _, _ in rects), min(y for _, y, _, _ in rects)
+    x1, y1 = max(x + w for x, _, w, _ in rects), max(y + h for _, y, _, h in rects)
+    prev_block, block = prev_frame[y0:y1, x0:x1], frame[y0:y1, x0:x1]
+
+    prev_rows, rows = line_hashes(prev_block), line_hashes(block)
+    dy, votes = find_shift(prev_rows, rows)
+    if votes >= MIN_SCROLL_LINES:
+        (y, h), runs = shifted_changes(prev_rows, rows, dy)
+        return ((x0, y0 + y, x1 - x0, h, x0, y0 + y + dy),
+                [(x0, y0 + top, x1 - x0, height) for top, height in runs])
+
+    prev_columns, columns = line_hashes(prev_block.swapaxes(0, 1)), line_hashes(block.swapaxes(0, 1))
+    dx, votes = find_shift(prev_columns, columns)
+    if votes >= MIN_SCROLL_LINES:
+        (x, w), runs = shifted_changes(prev_columns, columns, dx)
+        return ((x0 + x, y0, w, y1 - y0, x0 + x + dx, y0),
+                [(x0 + left, y0, width, y1 - y0) for left, width in runs])
+    return None
+
+
+def tile_hash(frame, x, y):
+    return hash(frame[y:y + TILE_SIZE, x:x + TILE_SIZE].tobytes())
+
+
+def subtract_tiles(rect, tiles, tile_size=TILE_SIZE):
+    """Cut the given whole tiles out of a rectangle, leaving runs of the remaining tiles per tile row"""
+    x, y, w, h = rect
+    pieces = []
+    for top in range(y - y % tile_size, y + h, tile_size):
+        y0, y1 = max(top, y), min(top + tile_size, y + h)
+        run = None
+        for left in range(x - x % tile_size, x + w, tile_size):
+            x0, x1 = max(left, x), min(left + tile_size, x + w)
+            if (left, top) in tiles:
+                if run:
+                    pieces.append(run)
+                run = None
+            elif run:
+                run = (run[0], y0, x1 - run[0], y1 - y0)
+            else:
+                run = (x0, y0, x1 - x0, y1 - y0)
+        if run:
+            pieces.append(run)
+    return pieces
+
+
+def match_cached_tiles(frame, rects):
+    """
+    Look up the whole tiles of the changed rectangles in the tile cache
+    Returns (references as (x, y, tile ID), rectangles still to encode, content hashes by tile position)
+    """
+    refs, remaining, hashes = [], [], {}
+    for rect in rects:
+        hits = set()
+        for x, y in whole_tiles([rect], TILE_SIZE):
+            key = hashes[(x, y)] = tile_hash(frame, x, y)
+            tile_id = tile_cache.lookup(key)
+            if tile_id is not None:
+                refs.append((x, y, tile_id))
+                hits.add((x, y))
+        remaining.extend(subtract_tiles(rect, hits) if hits else [rect])
+    return refs, remaining, hashes
+
+
+def cache_sent_tiles(frame, rects, reset, hashes):
+    """
+    Add the whole tiles of the rectangles being sent; the viewer adds the same ones once it decoded them
+    Only resynchronizing keyframes empty the cache, periodic ones keep it so windows seen long ago
+    still hit; their tiles are added again and the older copies age out of the LRU
+    """
+    if reset:
+        tile_cache.reset()
+    if not tile_cache.capacity:
+        return
+    for x, y in whole_tiles(split_stripes(rects), TILE_SIZE):
+        key = hashes.get((x, y))
+        tile_cache.add(None, tile_hash(frame, x, y) if key is None else key)
+    pipeline_stats.gauge('tile_cache_tiles', len(tile_cache))
+
+
+def split_stripes(rects, stripe_height=STRIPE_HEIGHT):
+    """Split rectangles taller than stripe_height into horizontal stripes that encode independently"""
+    stripes = []
+    for x, y, w, h in rects:
+        for top in range(y, y + h, stripe_height):
+            stripes.append((x, top, w, min(stripe_height, y + h - top)))
+    return stripes
+
+
+def encode_rect(frame, rect, encode_param):
+    x, y, w, h = rect
+    _, buffer = cv2.imencode('.jpg', frame[y:y + h, x:x + w], encode_param)
+    return protocol.FRAME_RECT.pack(x, y, w, h, len(buffer)), buffer.tobytes()
+
+
+def encode_tile_frame(frame, rects, seq, keyframe, quality=QUALITY, capture_time=0.0, inputs=0, copy=None,
+                      refs=(), cache_reset=False):
+    """
+    JPEG-encode each rectangle of the frame and pack them into one tile frame message
+    Large areas are cut into stripes and encoded on several cores; OpenCV releases the GIL
+    while encoding, so a full 4K frame takes about as long as its largest stripe
+    A copy rectangle and tile cache references, applied by the viewer before the tiles, reuse
+    content it already has
+    """
+    start = time.time()
+    height, width = frame.shape[:2]
+    flags = protocol.FLAG_KEYFRAME if keyframe else 0
+    if copy is not None:
+        flags |= protocol.FLAG_COPY
+    if refs:
+        flags |= protocol.FLAG_CACHED
+    if cache_reset:
+        flags |= protocol.FLAG_CACHE_RESET
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+
+    rects = split_stripes(rects)
+    if len(rects) > 1 and sum(w * h for _, _, w, h in rects) >= PARALLEL_ENCODE_AREA:
+        encoded = list(stripe_executor.map(lambda rect: encode_rect(frame, rect, encode_param), rects))
+    else:
+        encoded = [encode_rect(frame, rect, encode_param) for rect in rects]
+
+    parts = [protocol.FRAME_HEADER.pack(protocol.MSG_FRAME, flags, seq, protocol.pack_capture_time(capture_time),
+                                        inputs, width, height, len(rects))]
+    if copy is not None:
+        parts.append(protocol.COPY_RECT.pack(*copy))
+    if refs:
+        parts.append(protocol.CACHE_REFS.pack(len(refs)))
+        parts.extend(protocol.CACHE_REF.pack(*ref) for ref in refs)
+    for rect_header, jpeg in encoded:
+        parts.append(rect_header)
+        parts.append(jpeg)
+    pipeline_stats.record('encode', time.time() - start)
+    return b''.join(parts)
+
+
+class VideoEncoder:
+    """
+    Streaming H.264/VP8 encoder for the video screen modes
+    Frames must be encoded one at a time in capture order, since each is predicted from the last;
+    the codec is reopened, starting with a keyframe, whenever the frame size or quality changes
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.context = None
+        self.settings = None  # (width, height, quality) the codec was opened with
+        self.pts = 0
+
+    def open(self, width, height, quality):
+        context = av.CodecContext.create(VIDEO_CODECS[self.codec], 'w')
+        context.width = width
+        context.height = height
+        context.pix_fmt = 'yuv420p'
+        context.time_base = Fraction(1, FRAME_RATE)
+        context.gop_size = int(KEYFRAME_INTERVAL * FRAME_RATE)
+
+        # Map JPEG quality onto the codec's constant rate factor, where lower is better
+        worst = 51 if self.codec == 'h264' else 63
+        options = dict(VIDEO_OPTIONS[self.codec])
+        options['crf'] = str(round(worst - quality * worst / 110))
+        context.options = options
+
+        self.context = context
+        self.settings = (width, height, quality)
+        self.pts = 0
+
+    def encode(self, frame, seq, keyframe, quality=QUALITY, capture_time=0.0, inputs=0):
+        """Encode one frame into a video frame message, or None if the codec produced nothing"""
+        start = time.time()
+        # 4:2:0 chroma needs even dimensions
+        height, width = frame.shape[0] & ~1, frame.shape[1] & ~1
+        if self.settings != (width, height, quality):
+            self.open(width, height, quality)
+            keyframe = True
+
+        video_frame = av.VideoFrame.from_ndarray(frame[:height, :width], format='bgr24')
+        video_frame.pts = self.pts
+        self.pts += 1
+        if keyframe:
+            video_frame.pict_type = av.video.frame.PictureType.I
 
-def recvall(sock, size):
-    data = b''
-    while len(data) < size:
-        packet = sock.recv(min(size - len(data), 4096))
-        if not packet:
+        packets = self.context.encode(video_frame)
+        pipeline_stats.record('encode', time.time() - start)
+        if not packets:
             return None
-        data += packet
-    return data
+        flags = protocol.FLAG_KEYFRAME if any(packet.is_keyframe for packet in packets) else 0
+        parts = [protocol.VIDEO_HEADER.pack(protocol.MSG_VIDEO, flags, seq, protocol.pack_capture_time(capture_time),
+                                            inputs, width, height)]
+        parts.extend(bytes(packet) for packet in packets)
+        return b''.join(parts)
+
+
+class AdaptiveBitrate:
+    """
+    Feedback controller that adjusts JPEG quality, frame rate and scale factor at runtime
+    Latency is measured from capture until the controller acknowledges the frame; a growing
+    kernel send backlog or latency above TARGET_LATENCY_MS lowers the settings, headroom raises them
+    """
+
+    def __init__(self, enabled=ADAPTIVE_BITRATE, target_latency=TARGET_LATENCY_MS / 1000.0):
+        self.enabled = enabled
+        self.target_latency = target_latency
+        self.quality = QUALITY
+        self.scale_factor = SCALE_FACTOR
+        self.frame_rate = FRAME_RATE
+
+        self.lock = threading.Lock()
+        self.pending = {}  # seq -> capture time of frames awaiting acknowledgement
+        self.latencies = []
+        self.max_backlog = 0
+        self.last_adjust_time = time.time()
+
+    def on_frame_sent(self, seq, capture_time, send_duration, backlog):
+        with self.lock:
+            self.pending[seq] = capture_time
+            if backlog is not None:
+                self.max_backlog = max(self.max_backlog, backlog)
+            # Without a backlog reading, a blocking send is the only congestion signal
+            elif send_duration > self.target_latency:
+                self.max_backlog = max(self.max_backlog, MAX_SEND_BACKLOG + 1)
+
+            # Frames the relay dropped (e.g. no viewer yet) are never acknowledged
+            if len(self.pending) > 256:
+                for old_seq in sorted(self.pending, key=self.pending.get)[:128]:
+                    del self.pending[old_seq]
+        self.adjust()
+
+    def on_ack(self, seq):
+        with self.lock:
+            capture_time = self.pending.pop(seq, None)
+            if capture_time is not None:
+                self.latencies.append(time.time() - capture_time)
+                pipeline_stats.record('capture_to_ack', self.latencies[-1])
+
+    def settings(self):
+        """Return the current (quality, scale factor, frame rate)"""
+        with self.lock:
+            return self.quality, self.scale_factor, self.frame_rate
+
+    def adjust(self):
+        now = time.time()
+        with self.lock:
+            if not self.enabled or now - self.last_adjust_time < ADAPT_INTERVAL:
+                return
+            self.last_adjust_time = now
+
+            latency = max(self.latencies) if self.latencies else None
+            congested = (self.max_backlog > MAX_SEND_BACKLOG or
+                         (latency is not None and latency > self.target_latency))
+            idle_link = (self.max_backlog < MAX_SEND_BACKLOG // 4 and
+                         (latency is None or latency < self.target_latency / 2))
+            self.latencies = []
+            self.max_backlog = 0
+
+            previous = (self.quality, self.scale_factor, self.frame_rate)
+            if congested:
+                # Back off quickly: cheapest visual cost first, resolution last
+                if self.quality > MIN_QUALITY:
+                    self.quality = max(MIN_QUALITY, self.quality - 10)
+                elif self.frame_rate > MIN_FRAME_RATE:
+                    self.frame_rate = max(MIN_FRAME_RATE, self.frame_rate * 0.75)
+                elif self.scale_factor > MIN_SCALE_FACTOR:
+                    self.scale_factor = max(MIN_SCALE_FACTOR, round(self.scale_factor - 0.1, 2))
+            elif idle_link:
+                # Recover gradually in the reverse order
+                if self.scale_factor < SCALE_FACTOR:
+                    self.scale_factor = min(SCALE_FACTOR, round(self.scale_factor + 0.1, 2))
+                elif self.frame_rate < FRAME_RATE:
+                    self.frame_rate = min(FRAME_RATE, self.frame_rate + 1)
+                elif self.quality < QUALITY:
+                    self.quality = min(QUALITY, self.quality + 5)
+
+            current = (self.quality, self.scale_factor, self.frame_rate)
+        if current != previous:
+            print(f"Adaptive bitrate: quality {current[0]}, scale {current[1]:.2f}, {current[2]:.1f} fps")
 
 
 # Now actually control keyboard instead of just simulating
 def handle_keyboard_input(key_data):
-    """Handle keyboard input commands using pyautogui"""
+    """Handle keyboard input commands through the injection backend"""
     action = key_data.get('type')
     key = key_data.get('key')
 
     try:
-        if action == 'press':
-            print(f"Keyboard press: {key}")
-            pyautogui.keyDown(key)
-        elif action == 'release':
-            print(f"Keyboard release: {key}")
-            pyautogui.keyUp(key)
+        if action in ('press', 'release'):
+            log.debug("Keyboard %s: %s", action, key)
+            input_backend.key(key, action == 'press')
     except Exception as e:
-        print(f"Error controlling keyboard: {e}")
+        log.warning("Error controlling keyboard: %s", e)
 
 
 # Now actually control mouse instead of just simulating
-def handle_mouse_input(mouse_data, screen_width, screen_height):
-    """Handle mouse input commands using pyautogui"""
+def handle_mouse_input(mouse_data, region):
+    """Handle mouse input commands through the injection backend"""
     action = mouse_data.get('type')
 
     try:
         if action == 'move':
-            # Convert normalized position (0.0-1.0) to actual pixel position
-            x = int(mouse_data.get('x') * screen_width)
-            y = int(mouse_data.get('y') * screen_height)
-            print(f"Mouse moved to: {x}, {y}")
-            pyautogui.moveTo(x, y)
+            # Convert normalized position (0.0-1.0) within the captured region to desktop pixels
+            x = region['left'] + int(mouse_data.get('x') * region['width'])
+            y = region['top'] + int(mouse_data.get('y') * region['height'])
+            log.debug("Mouse moved to: %d, %d", x, y)
+            input_backend.move(x, y)
 
         elif action == 'click':
             button = mouse_data.get('button')
             btn_action = mouse_data.get('action')
 
-            if button == 'left':
-                if btn_action == 'press':
-                    print(f"Left mouse button pressed")
-                    pyautogui.mouseDown(button='left')
-                elif btn_action == 'release':
-                    print(f"Left mouse button released")
-                    pyautogui.mouseUp(button='left')
-
-            elif button == 'right':
-                if btn_action == 'press':
-                    print(f"Right mouse button pressed")
-                    pyautogui.mouseDown(button='right')
-                elif btn_action == 'release':
-                    print(f"Right mouse button released")
-                    pyautogui.mouseUp(button='right')
+            if button in ('left', 'middle', 'right') and btn_action in ('press', 'release'):
+                log.debug("Mouse %s button %s", button, btn_action)
+                input_backend.button(button, btn_action == 'press')
     except Exception as e:
-        print(f"Error controlling mouse: {e}")
+        log.warning("Error controlling mouse: %s", e)
+
+
+def inject_input(key_data):
+    """Inject one decoded input record; runs on the injection worker"""
+    key_type = key_data.get('type')
+    if key_type in ['press', 'release']:
+        handle_keyboard_input(key_data)
+    elif key_type in ['move', 'click']:
+        handle_mouse_input(key_data, capture_region)
+
 
+def on_inputs_applied(count):
+    global inputs_applied
 
-def handle_input(input_socket, stop_event, screen_width, screen_height):
-    """Handle input commands from controller client"""
+    # Frames captured from now on reflect these records
+    inputs_applied += count
+
+
+def handle_input(input_socket, stop_event, injector):
+    """Read input commands from the controller client and queue them for injection"""
+    reader = FrameReader(input_socket)
     try:
         while not stop_event.is_set():
             try:
-                key_data = recvmsg(input_socket)
-                if not key_data:
-                    time.sleep(0.01)
-                    continue
-
-                key_type = key_data.get('type')
+                data = reader.read_message()
+                if data is None:
+                    print("Input connection closed")
+                    break
+                if protocol.message_type(data) == protocol.MSG_CONTROL:
+                    continue  # Relay notifications such as connection_status, not counted as input
+                if protocol.message_type(data) == protocol.MSG_BATCH:
+                    records = protocol.decode_batch(data)
+                else:
+                    records = [data]
 
-                if key_type in ['press', 'release']:
-                    handle_keyboard_input(key_data)
-                elif key_type in ['move', 'click']:
-                    handle_mouse_input(key_data, screen_width, screen_height)
+                # Unknown records are still counted, so the input round trip stays in step
+                injector.submit([protocol.decode_input(record) or {} for record in records])
+                pipeline_stats.count('inputs', len(records))
 
             except Exception as e:
                 print(f"Error handling input: {e}")
@@ -139,95 +528,482 @@ def handle_input(input_socket, stop_event, screen_width, screen_height):
         print("Input handler thread stopped")
 
 
-def main():
-    screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    input_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def handle_screen_control(screen_socket, stop_event, bitrate, force_keyframe):
+    """Handle control messages sent back to us on the screen connection"""
+    reader = FrameReader(screen_socket)
+    try:
+        while not stop_event.is_set():
+            data = reader.read_message()
+            if data is None:
+                break
 
-    stop_event = Event()
-    input_thread = None
+            kind = protocol.message_type(data)
+            if kind == protocol.MSG_FRAME_ACK:
+                bitrate.on_ack(protocol.decode_frame_ack(data))
+            elif kind == protocol.MSG_KEYFRAME_REQUEST:
+                # A viewer joined or fell behind and dropped deltas
+                force_keyframe.set()
+            elif kind == protocol.MSG_CONTROL:
+                try:
+                    message = protocol.decode_control(data)
+                except ValueError as e:
+                    print(f"Invalid control message: {e}")
+                    continue
+                if isinstance(message, dict) and message.get('type') == 'connection_status':
+                    print(f"Connection status: {message.get('status')}")
+                elif isinstance(message, dict) and message.get('type') == 'udp_setup':
+                    setup_datagram_link(message, force_keyframe)
+                elif isinstance(message, dict) and message.get('type') == 'viewer_size':
+                    set_viewer_size(message)
+                elif isinstance(message, dict) and message.get('type') == 'select_region':
+                    try:
+                        select_capture_region(message.get('monitor', 0), message.get('region'))
+                    except (ValueError, TypeError) as e:
+                        print(f"Invalid capture region: {e}")
+                        continue
+                    # The new region has a new size, so the viewer needs its description and a full frame
+                    with screen_send_lock:
+                        sendmsg(screen_socket, screen_info)
+                    force_keyframe.set()
+    except (ConnectionError, OSError) as e:
+        print(f"Screen control connection error: {e}")
+    finally:
+        print("Screen control thread stopped")
 
-    try:
-        print(f"Connecting to server at {SERVER_HOST}...")
-        screen_socket.connect((SERVER_HOST, SCREEN_PORT))
-        input_socket.connect((SERVER_HOST, INPUT_PORT))
 
-        print("Connected to server successfully")
-        sendmsg(screen_socket, 'controlled_screen')
-        sendmsg(input_socket, 'controlled_input')
+def setup_datagram_link(message, force_keyframe):
+    """Move screen frames to UDP if datagrams get through to the relay, otherwise stay on TCP"""
+    global datagram_link
 
-        # Get screen dimensions
-        with mss.mss() as sct:
-            monitor = sct.monitors[0]  # Primary monitor
-            screen_width, screen_height = monitor["width"], monitor["height"]
+    link = DatagramLink(SERVER_HOST, message['port'], message['token'])
+    if link.handshake():
+        print("Sending screen frames over UDP")
+        datagram_link = link
+        force_keyframe.set()
+    else:
+        print("UDP screen transport unavailable, staying on TCP")
+        link.close()
 
-        # Send screen information to the controller
-        screen_info = {
-            'type': 'screen_info',
-            'width': screen_width,
-            'height': screen_height
-        }
-        sendmsg(screen_socket, screen_info)
 
-        # Start input handler thread
-        input_thread = Thread(target=handle_input, args=(input_socket, stop_event, screen_width, screen_height))
-        input_thread.daemon = True
-        input_thread.start()
+def set_viewer_size(message):
+    global viewer_size
 
-        # Start screen capture loop
-        with mss.mss() as sct:
-            # Define capture area (entire primary monitor)
-            monitor = sct.monitors[0]
+    size = (message['width'], message['height']) if 'width' in message and 'height' in message else None
+    if size != viewer_size:
+        viewer_size = size
+        print(f"Viewer display size: {f'{size[0]}x{size[1]}' if size else 'unknown'}")
 
-            # Scale dimensions if needed
-            capture_width = int(monitor["width"] * SCALE_FACTOR)
-            capture_height = int(monitor["height"] * SCALE_FACTOR)
 
-            print(f"Capturing screen at {capture_width}x{capture_height}")
+def viewer_scale(width, height):
+    """Scale factor that fits a width x height capture into the viewer's display, at most 1"""
+    if viewer_size is None:
+        return 1.0
+    scale = min(viewer_size[0] / width, viewer_size[1] / height, 1.0)
+    # Round down to steps of 1/32, so a window being resized does not change the frame size every pixel
+    return max(int(scale * 32) / 32, 1 / 32)
 
-            # Main screen capture loop
-            frame_interval = 1.0 / FRAME_RATE
+
+def select_capture_region(monitor, region=None):
+    """
+    Capture one monitor, or the part of it given as normalized (x, y, width, height) fractions
+    Frames, input mapping and the screen_info the viewer gets all follow the new region
+    """
+    global capture_region, screen_info
+
+    if not 0 <= monitor < len(monitors):
+        raise ValueError(f"no monitor {monitor}, there are {len(monitors) - 1}")
+    area = monitors[monitor]
+    if region is None:
+        region = (0.0, 0.0, 1.0, 1.0)
+    x, y, width, height = (min(max(float(value), 0.0), 1.0) for value in region)
+
+    # Keep the region inside the monitor and large enough to be useful
+    width = min(max(int(width * area['width']), MIN_REGION_SIZE), area['width'])
+    height = min(max(int(height * area['height']), MIN_REGION_SIZE), area['height'])
+    left = min(int(x * area['width']), area['width'] - width)
+    top = min(int(y * area['height']), area['height'] - height)
+
+    capture_region = {'left': area['left'] + left, 'top': area['top'] + top, 'width': width, 'height': height}
+    screen_info = dict(screen_info or {'type': 'screen_info'},
+                       width=width, height=height, monitor=monitor, monitors=len(monitors) - 1,
+                       region=[left / area['width'], top / area['height'],
+                               width / area['width'], height / area['height']])
+    print(f"Capturing monitor {monitor} region {width}x{height} at {capture_region['left']},{capture_region['top']}")
+
+
+def put_drop_oldest(q, item, merge=None):
+    """
+    Put an item on a bounded queue, discarding the oldest entries while it is full
+    merge(dropped, following) returns what replaces the entry right after a discarded one, for
+    items that carry state forward; it runs under the queue's lock, so the consumer never takes
+    that entry before the state is folded in
+    """
+    dropped = 0
+    with q.mutex:
+        entries = q.queue
+        while 0 < q.maxsize <= len(entries):
+            old = entries.popleft()
+            dropped += 1
+            if merge is not None:
+                if entries:
+                    entries[0] = merge(old, entries[0])
+                else:
+                    item = merge(old, item)
+        entries.append(item)
+        q.unfinished_tasks += 1
+        q.not_empty.notify()
+    return dropped
+
+
+def merge_damage(dropped, frame):
+    """
+    Carry a dropped raw frame's damage over to the frame queued after it: damage is relative to
+    the previous grab, and the encoder compares against the last frame it actually saw
+    """
+    capture_time, inputs, img, damage = frame
+    if damage is not None:
+        damage = None if dropped[3] is None else dropped[3] + damage
+    return capture_time, inputs, img, damage
+
+
+def capture_frames(capture_queue, stop_event, bitrate, backend, force_keyframe):
+    """
+    Pipeline stage 1: grab the screen at the current frame rate and queue raw frames
+    Backends that track damage let an idle screen sleep instead of being grabbed and compared;
+    a frame is still queued when a keyframe is requested or due
+    """
+    last_frame_time = time.time()
+    last_queued = 0.0
+
+    while not stop_event.is_set():
+        _, scale_factor, frame_rate = bitrate.settings()
+
+        # Throttle to target frame rate
+        frame_interval = 1.0 / frame_rate
+        current_time = time.time()
+        time_since_last_frame = current_time - last_frame_time
+        if time_since_last_frame < frame_interval:
+            time.sleep(frame_interval - time_since_last_frame)
+
+        keyframe_due = force_keyframe.is_set() or time.time() - last_queued >= KEYFRAME_INTERVAL
+        if not backend.wait(IDLE_WAIT) and not keyframe_due:
+            continue
+
+        try:
             last_frame_time = time.time()
+            inputs = inputs_applied
 
-            while True:
-                # Throttle to target frame rate
-                current_time = time.time()
-                time_since_last_frame = current_time - last_frame_time
-                if time_since_last_frame < frame_interval:
-                    time.sleep(frame_interval - time_since_last_frame)
+            # Capture only the region the viewer selected; it may change between frames
+            monitor = capture_region
+            img, damage = backend.grab(monitor)
+            if damage == [] and not keyframe_due:
+                continue  # Drawing happened outside the captured region
 
-                try:
-                    # Capture screen
-                    img = np.array(sct.grab(monitor))
+            # FIX: Proper color conversion for screen capture
+            # mss captures in BGRA format, so we need to convert it correctly
+            # The issue was the color channel ordering - BGR vs RGB
+
+            # Method 1: Direct BGR to RGB conversion (more accurate)
+            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
 
-                    # FIX: Proper color conversion for screen capture
-                    # mss captures in BGRA format, so we need to convert it correctly
-                    # The issue was the color channel ordering - BGR vs RGB
+            # Scale if needed; pixels the viewer cannot show are never encoded
+            scale_factor = min(scale_factor, viewer_scale(monitor['width'], monitor['height']))
+            if scale_factor != 1.0:
+                capture_width = int(monitor["width"] * scale_factor)
+                capture_height = int(monitor["height"] * scale_factor)
+                img_rgb = cv2.resize(img_rgb, (capture_width, capture_height),
+                                     interpolation=cv2.INTER_AREA)
+                if damage:
+                    # Grow each rectangle by a pixel, resampling blends in the neighbours
+                    damage = [(int(x * scale_factor), int(y * scale_factor),
+                               int(w * scale_factor) + 2, int(h * scale_factor) + 2) for x, y, w, h in damage]
 
-                    # Method 1: Direct BGR to RGB conversion (more accurate)
-                    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+            pipeline_stats.record('capture', time.time() - last_frame_time)
 
-                    # Scale if needed
-                    if SCALE_FACTOR != 1.0:
-                        img_rgb = cv2.resize(img_rgb, (capture_width, capture_height),
-                                             interpolation=cv2.INTER_AREA)
+            # A stale raw frame is worthless, so the newest capture always wins
+            dropped = put_drop_oldest(capture_queue, (last_frame_time, inputs, img_rgb, damage), merge_damage)
+            last_queued = last_frame_time
+            if dropped:
+                pipeline_stats.count('frames_dropped', dropped)
+        except Exception as e:
+            print(f"Error capturing screen: {e}")
+            time.sleep(1)  # Wait before retrying on error
 
-                    # Compress as JPEG with proper color encoding
-                    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), QUALITY]
-                    _, buffer = cv2.imencode('.jpg', img_rgb, encode_param)
 
-                    # Send frame size then frame data
-                    frame_data = buffer.tobytes()
-                    frame_size = len(frame_data)
-                    screen_socket.sendall(struct.pack(">L", frame_size) + frame_data)
+def encode_frames(capture_queue, send_queue, executor, stop_event, force_keyframe, bitrate, video=None):
+    """
+    Pipeline stage 2: pick the tiles to send and hand JPEG encoding to the thread pool
+    Change detection stays on this thread because each delta depends on the frame before it
+    With a VideoEncoder the whole frame goes to the codec instead, skipping unchanged frames
+    """
+    prev_frame = None
+    last_keyframe_time = 0.0
+    seq = 0
 
-                    last_frame_time = time.time()
+    while not stop_event.is_set():
+        try:
+            capture_time, inputs, img_rgb, damage = capture_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
 
-                except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
-                    print(f"Connection error: {e}")
+        if send_queue.full():
+            # The socket is behind: every queued frame is stale, and deltas after a
+            # gap cannot be applied, so discard them all and resynchronize with a full frame
+            while True:
+                try:
+                    send_queue.get_nowait()[2].cancel()
+                    pipeline_stats.count('frames_dropped')
+                except queue.Empty:
                     break
+            force_keyframe.set()
+
+        # Only send the tiles that changed since the previous frame, with a
+        # periodic full frame so late joiners and resizes resynchronize
+        # Resynchronizing keyframes (a new viewer, a lost frame, a resize) also reset the tile cache
+        # The request is taken here and only here; one arriving later is kept for the next frame
+        forced = force_keyframe.is_set()
+        if forced:
+            force_keyframe.clear()
+        resync = prev_frame is None or prev_frame.shape != img_rgb.shape or forced
+        keyframe = resync or capture_time - last_keyframe_time >= KEYFRAME_INTERVAL
+        copy = None
+        refs = []
+        hashes = {}
+        if video is not None:
+            # The codec finds the changes itself, only frames identical to the last one are skipped
+            if not keyframe and (damage == [] or np.array_equal(prev_frame, img_rgb)):
+                continue
+            rects = None
+        elif keyframe:
+            rects = [(0, 0, img_rgb.shape[1], img_rgb.shape[0])]
+        else:
+            rects = find_dirty_rects(prev_frame, img_rgb, damage=damage)
+            dirty_area = sum(w * h for _, _, w, h in rects)
+            frame_area = img_rgb.shape[0] * img_rgb.shape[1]
+            if SCROLL_DETECTION and dirty_area > SCROLL_DETECT_RATIO * frame_area:
+                # Scrolling changes most pixels but only exposes a strip; send the rest as a copy
+                scroll = detect_scroll(prev_frame, img_rgb, rects)
+                if scroll is not None:
+                    scroll_area = sum(w * h for _, _, w, h in scroll[1])
+                    if scroll_area < dirty_area / 2:
+                        (copy, rects), dirty_area = scroll, scroll_area
+                        pipeline_stats.count('copy_rects')
+            if tile_cache.capacity and rects:
+                # Content the viewer has seen recently, e.g. a window brought back to the front
+                refs, rects, hashes = match_cached_tiles(img_rgb, rects)
+                dirty_area = sum(w * h for _, _, w, h in rects)
+                pipeline_stats.count('tile_cache_hits', len(refs))
+                pipeline_stats.gauge('tile_cache_hit_rate', tile_cache.hit_rate())
+            if dirty_area > FULL_FRAME_RATIO * frame_area:
+                keyframe = True
+                copy = None
+                refs = []
+                rects = [(0, 0, img_rgb.shape[1], img_rgb.shape[0])]
+
+        prev_frame = img_rgb
+        if keyframe:
+            last_keyframe_time = capture_time
+
+        if video is None:
+            if not rects and copy is None and not refs:
+                continue
+            cache_sent_tiles(img_rgb, rects, resync, hashes)
+
+        quality = bitrate.settings()[0]
+        if video is not None:
+            # The pool has a single worker in video mode, so frames reach the codec in order
+            future = executor.submit(video.encode, img_rgb, seq, keyframe, quality, capture_time, inputs)
+        else:
+            # OpenCV releases the GIL while encoding, so several frames encode in parallel
+            future = executor.submit(encode_tile_frame, img_rgb, rects, seq, keyframe, quality, capture_time, inputs,
+                                     copy, refs, resync)
+        send_queue.put((seq, capture_time, future))
+        seq = (seq + 1) & 0xFFFFFFFF
+
+
+def send_frames(screen_socket, send_queue, stop_event, bitrate):
+    """Pipeline stage 3: write encoded frames to the socket in capture order"""
+    try:
+        while not stop_event.is_set():
+            pipeline_stats.maybe_dump()
+            link = datagram_link
+            if link is not None:
+                link.keepalive(time.time())
+            try:
+                seq, capture_time, future = send_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if future.cancelled():
+                continue
+
+            try:
+                frame_data = future.result()
+            except Exception as e:
+                print(f"Error encoding frame: {e}")
+                continue
+            if frame_data is None:
+                continue
+
+            # Send frame size then frame data, or the frame's fragments over UDP
+            send_start = time.time()
+            if link is not None:
+                try:
+                    link.send_frame(frame_data, seq)
+                except OSError as e:
+                    # Datagrams are best effort, the viewer asks for a keyframe if it misses this one
+                    print(f"Error sending frame datagrams: {e}")
+                    pipeline_stats.count('frames_dropped')
+                    continue
+                backlog = get_send_backlog(link.sock)
+            else:
+                with screen_send_lock:
+                    send_message(screen_socket, frame_data)
+                backlog = get_send_backlog(screen_socket)
+            send_duration = time.time() - send_start
+            bitrate.on_frame_sent(seq, capture_time, send_duration, backlog)
+
+            pipeline_stats.record('capture_to_send', send_start - capture_time)
+            pipeline_stats.record('send', send_duration)
+            pipeline_stats.count('frames_sent')
+            pipeline_stats.count('bytes_sent', len(frame_data))
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, OSError) as e:
+        print(f"Connection error: {e}")
+    finally:
+        stop_event.set()
+
+
+def send_cursor(screen_socket, stop_event, backend):
+    """
+    Send the pointer as its own small messages, polled faster than frames are captured
+    Each shape is sent once, the controller draws it over the screen itself; shape ID 0 means
+    the backend cannot read the pointer image and the controller draws a default arrow
+    """
+    sent_shapes = set()
+    last_position = None
+    try:
+        while not stop_event.is_set():
+            time.sleep(1.0 / CURSOR_RATE)
+            # Poll once the socket is free, a position read before waiting behind a frame write is stale
+            with screen_send_lock:
+                try:
+                    pointer = backend.cursor()
                 except Exception as e:
-                    print(f"Error capturing screen: {e}")
-                    time.sleep(1)  # Wait before retrying on error
+                    print(f"Error reading the cursor: {e}")
+                    pointer = None
+                if pointer is None:
+                    continue
+                x, y, shape = pointer
+                region = capture_region
+                shape_id = 0
+                if shape is not None:
+                    shape_id, hotspot_x, hotspot_y, image = shape
+                    if shape_id not in sent_shapes:
+                        ok, png = cv2.imencode('.png', image)
+                        if ok:
+                            send_message(screen_socket,
+                                         protocol.encode_cursor_shape(shape_id, hotspot_x, hotspot_y, png.tobytes()))
+                            sent_shapes.add(shape_id)
+                            pipeline_stats.count('cursor_shapes_sent')
+
+                # Positions are relative to the captured region, the pointer is hidden while outside it
+                rel_x, rel_y = x - region['left'], y - region['top']
+                visible = 0 <= rel_x < region['width'] and 0 <= rel_y < region['height']
+                position = (rel_x / region['width'], rel_y / region['height'], shape_id, visible)
+                if position == last_position:
+                    continue
+                last_position = position
+                send_message(screen_socket, protocol.encode_cursor_position(*position))
+            pipeline_stats.count('cursor_updates_sent')
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, OSError) as e:
+        print(f"Connection error: {e}")
+    finally:
+        stop_event.set()
+
+
+def main():
+    global screen_info, input_backend
+
+    logging.basicConfig(level=LOG_LEVEL.upper(), format='%(message)s')
+
+    screen_socket = create_socket('screen')
+    input_socket = create_socket('input')
+
+    stop_event = Event()
+    input_thread = None
+    capture_thread = None
+    cursor_thread = None
+    executor = None
+    backend = None
+
+    try:
+        print(f"Connecting to server at {SERVER_HOST}...")
+        screen_socket.connect((SERVER_HOST, SCREEN_PORT))
+        input_socket.connect((SERVER_HOST, INPUT_PORT))
+
+        print("Connected to server successfully")
+        sendmsg(screen_socket, {'client_type': 'controlled_screen', 'session': SESSION_ID,
+                                'transport': SCREEN_TRANSPORT})
+        sendmsg(input_socket, {'client_type': 'controlled_input', 'session': SESSION_ID})
+
+        codec = SCREEN_CODEC
+        if codec != 'jpeg' and (av is None or codec not in VIDEO_CODECS):
+            print(f"Screen codec {codec} is not available (requires PyAV), using JPEG tiles")
+            codec = 'jpeg'
+        video = VideoEncoder(codec) if codec != 'jpeg' else None
+
+        # Get the monitor layout; the viewer can switch monitors or zoom into a region later
+        backend = capture.open_backend()
+        print(f"Capturing the screen with the {backend.name} backend")
+        monitors[:] = backend.monitors
+        # The viewer sizes its tile cache from screen_info, which it always gets before the first frame
+        screen_info = {'type': 'screen_info', 'codec': codec, 'tile_size': TILE_SIZE,
+                       'tile_cache': TILE_CACHE_TILES if video is None else 0}
+        try:
+            select_capture_region(CAPTURE_MONITOR)
+        except ValueError as e:
+            print(f"Invalid CAPTURE_MONITOR: {e}, capturing the whole desktop")
+            select_capture_region(0)
+
+        # Send screen information to the controller
+        sendmsg(screen_socket, screen_info)
+
+        # Read input on one thread and inject it on another, so a slow injection never backs up the socket
+        input_backend = injection.open_backend()
+        print(f"Injecting input with the {input_backend.name} backend")
+        injector = injection.InputInjector(input_backend, inject_input, on_inputs_applied, pipeline_stats)
+        injector_thread = Thread(target=injector.run, args=(stop_event,))
+        injector_thread.daemon = True
+        injector_thread.start()
+        input_thread = Thread(target=handle_input, args=(input_socket, stop_event, injector))
+        input_thread.daemon = True
+        input_thread.start()
+
+        # Start the capture -> encode -> send pipeline; each stage runs at its own
+        # pace so throughput is bounded by the slowest stage, not the sum of all three
+        capture_queue = queue.Queue(maxsize=CAPTURE_QUEUE_SIZE)
+        send_queue = queue.Queue(maxsize=SEND_QUEUE_SIZE)
+        force_keyframe = Event()
+        executor = ThreadPoolExecutor(max_workers=1 if video else ENCODE_WORKERS)
+        bitrate = AdaptiveBitrate()
+
+        capture_thread = Thread(target=capture_frames, args=(capture_queue, stop_event, bitrate, backend,
+                                                             force_keyframe))
+        cursor_thread = Thread(target=send_cursor, args=(screen_socket, stop_event, backend))
+        pipeline_threads = [
+            Thread(target=handle_screen_control, args=(screen_socket, stop_event, bitrate, force_keyframe)),
+            capture_thread,
+            Thread(target=encode_frames, args=(capture_queue, send_queue, executor, stop_event, force_keyframe,
+                                               bitrate, video)),
+            Thread(target=send_frames, args=(screen_socket, send_queue, stop_event, bitrate)),
+            cursor_thread,
+        ]
+        for thread in pipeline_threads:
+            thread.daemon = True
+            thread.start()
+
+        # Wait until a stage stops the pipeline (e.g. the server went away)
+        while not stop_event.is_set():
+            stop_event.wait(0.5)
 
     except KeyboardInterrupt:
         print("Controlled client shutting down...")
@@ -238,6 +1014,17 @@ def main():
         stop_event.set()
         if input_thread and input_thread.is_alive():
             input_thread.join(timeout=1.0)
+        # Both threads use the backend's display connection
+        backend_threads = [thread for thread in (capture_thread, cursor_thread) if thread]
+        for thread in backend_threads:
+            if thread.is_alive():
+                thread.join(timeout=1.0)
+        if backend and not any(thread.is_alive() for thread in backend_threads):
+            # Never pull the display out from under a grab that is still running
+            backend.close()
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        pipeline_stats.dump()
 
         screen_socket.close()
         input_socket.close()
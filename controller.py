@@ -1,16 +1,43 @@
-import socket
 import pygame
+import functools
 import io
-import struct
+import collections
 from PIL import Image
-import json
 import time
 import os
+import queue
+import select
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import av  # Optional: PyAV, only needed when the controlled client streams video
+except ImportError:
+    av = None
+
+import protocol
+import stats
+from connection import create_socket
+from datagram import DatagramLink, Reassembler, seq_newer
+from framing import FrameReader, MessageAssembler, send_message
+from protocol import sendmsg
+from tilecache import TileCache, whole_tiles
 
 # Server address - configurable via environment variables
 SERVER_HOST = os.getenv('SERVER_HOST', '192.168.0.188')
 SCREEN_PORT = int(os.getenv('SCREEN_PORT', '12345'))
 INPUT_PORT = int(os.getenv('INPUT_PORT', '12346'))
+SESSION_ID = os.getenv('SESSION_ID', 'default')  # Pairs this client with its peer on a shared server
+SCREEN_TRANSPORT = os.getenv('SCREEN_TRANSPORT', 'tcp')  # 'udp' receives screen frames as datagrams
+
+# Rendering configuration
+MAX_DECODE_SCALE = 8  # JPEG tiles can be decoded at 1/2, 1/4 or 1/8 of their size
+DECODE_WORKERS = int(os.getenv('DECODE_WORKERS', str(os.cpu_count() or 2)))
+PARALLEL_DECODE_AREA = 512 * 512  # Frames with fewer changed pixels are decoded on a single thread
+IDLE_REDRAW_DELAY = 0.25  # Seconds without frames before the screen is redrawn with LANCZOS
+KEYFRAME_REQUEST_INTERVAL = 0.5  # Seconds between keyframe requests while frames are being lost
+VIEWER_SIZE_DELAY = 0.3  # Seconds a new window size has to hold before it is reported
+LOCAL_CURSOR_HOLD = 0.5  # Seconds after local mouse motion during which the local pointer position is drawn
 
 # Global variables
 screen = None
@@ -21,34 +48,181 @@ original_size = (1024, 768)  # Default windowed size
 remote_width = 1920  # Default, will be updated from remote
 remote_height = 1080  # Default, will be updated from remote
 mouse_pressed = {"left": False, "right": False}  # Track mouse button state
+remote_monitor = 0  # Monitor the controlled client captures, 0 is its whole desktop
+remote_monitors = 0  # Number of monitors the controlled client has
+remote_region = (0.0, 0.0, 1.0, 1.0)  # Captured part of that monitor as normalized x, y, width, height
+region_select = None  # 'armed' after F9, then the drag's start point until the button is released
+framebuffer = None  # Persistent remote screen image that tile frames are composited onto
+decode_scale = 1  # The framebuffer holds the remote screen at 1/decode_scale of its size
+last_frame_seq = None  # Sequence number of the last frame applied
+awaiting_keyframe = False  # A frame was lost and deltas are skipped until the next keyframe
+last_keyframe_request = 0.0
+video_decoder = None  # Codec context when the controlled client streams video instead of tiles
+tile_cache = TileCache()  # Mirror of the controlled client's tile cache, holding decoded tiles
+tile_cache_size = (0, 64)  # Capacity and tile size announced in screen_info, applied at the next cache reset
+tile_cache_seq = None  # Last tile frame the cache followed; a gap means it no longer matches the sender's
+copy_resampled = False  # A copy moved content by a fraction of a pixel, blurring it until the next keyframe
+window_size = None  # Current window size, published by the render loop for the receive thread
+reported_size = None  # Window size last reported to the controlled client
+pending_size = None  # Window size waiting for a resize to settle, and since when
+pending_since = 0.0
+# Newest scaled frame waiting to be shown: (seq, capture time, inputs applied, publish time, RGB bytes, size,
+# offset); seq, capture time and inputs are None for idle redraws
+latest_frame = None
+frame_lock = threading.Lock()
+control_messages = queue.Queue()  # Control messages for the render loop; None once the server is gone
+send_lock = threading.Lock()  # Both threads acknowledge frames on the screen socket
+viewer_stats = stats.Stats('controller')
+decode_executor = ThreadPoolExecutor(max_workers=DECODE_WORKERS)  # Decodes the stripes of large tile frames
+show_stats = False  # Statistics overlay, toggled with F3
+cursor_images = {}  # Remote cursor shape ID -> (RGBA bytes, size, hotspot), decoded by the receive thread
+remote_cursor = None  # Latest remote pointer as (x, y, shape ID, visible), x and y normalized to the screen
+last_local_motion = 0.0  # When the local mouse last moved over the remote screen
+
+
+class InputBatcher:
+    """
+    Collects the input records generated during one render tick and sends them in one write
+    Consecutive mouse moves collapse into the latest position; a click or key in between
+    keeps its place, so the controlled side still sees events in the order they happened
+    """
 
+    def __init__(self):
+        self.records = []
+        self.last_was_move = False
+        self.writes = 0  # Writes sent so far, numbered like the relay's INPUT_ACKs
+        self.unacknowledged = collections.deque(maxlen=256)  # (write number, send time) the relay has not placed yet
+        self.forwarded = collections.deque()  # (controlled client's record count once applied, send time)
+        self.last_applied = 0  # Record count stamped on the last frame shown
+        self.acks = MessageAssembler(reuse_buffers=False, scratch_size=4096)  # Reads the input connection
+
+    def add_move(self, x, y):
+        record = protocol.encode_move(x, y)
+        if self.last_was_move:
+            self.records[-1] = record
+        else:
+            self.records.append(record)
+        self.last_was_move = True
+
+    def add(self, record):
+        self.records.append(record)
+        self.last_was_move = False
+
+    def flush(self, sock):
+        if not self.records:
+            return
+        records, self.records = self.records, []
+        self.last_was_move = False
+        if len(records) == 1:
+            send_message(sock, records[0])
+        else:
+            send_message(sock, protocol.encode_batch(records))
+        self.writes += 1
+        self.unacknowledged.append((self.writes, time.time()))
+
+    def read_acks(self, sock):
+        """Take in the relay's INPUT_ACKs without blocking the render loop"""
+        while select.select([sock], [], [], 0)[0]:
+            nbytes = sock.recv_into(self.acks.get_buffer())
+            if not nbytes:
+                return
+            for data in self.acks.buffer_updated(nbytes):
+                if protocol.message_type(data) == protocol.MSG_INPUT_ACK:
+                    self.on_ack(*protocol.decode_input_ack(data))
+
+    def on_ack(self, write, records):
+        """The relay passed write number `write` on; frames reflect it once their count reaches `records`"""
+        while self.unacknowledged and self.unacknowledged[0][0] < write:
+            self.unacknowledged.popleft()  # Never delivered, no controlled client was connected
+        if self.unacknowledged and self.unacknowledged[0][0] == write:
+            self.forwarded.append((records, self.unacknowledged.popleft()[1]))
+
+    def on_frame_shown(self, inputs_applied):
+        """Record the round trip of every write the displayed frame already reflects"""
+        if inputs_applied < self.last_applied:
+            # A new controlled client counts from zero, the writes placed in the old count are lost
+            self.forwarded.clear()
+        self.last_applied = inputs_applied
+        sent_time = None
+        while self.forwarded and self.forwarded[0][0] <= inputs_applied:
+            sent_time = self.forwarded.popleft()[1]
+        if sent_time is not None:
+            viewer_stats.record('input_round_trip', time.time() - sent_time)
+
+
+input_batch = InputBatcher()
+
+
+def default_cursor():
+    """Arrow drawn while the controlled client cannot read its cursor image"""
+    surface = pygame.Surface((12, 19), pygame.SRCALPHA)
+    points = [(0, 0), (0, 16), (4, 12), (7, 18), (9, 17), (6, 11), (11, 11)]
+    pygame.draw.polygon(surface, (0, 0, 0), points)
+    pygame.draw.polygon(surface, (255, 255, 255), points, 1)
+    return surface, (0, 0)
+
+
+class CursorOverlay:
+    """
+    Draws the remote pointer over the screen image, so it moves at the render rate instead of
+    the frame rate. The pixels under the pointer are saved, so moving it only redraws two small
+    rectangles instead of the whole window
+    """
 
-def sendmsg(socket, key_data):
-    data = json.dumps(key_data).encode()
-    size = len(data)
-    socket.sendall(struct.pack(">L", size) + data)
-
+    def __init__(self):
+        self.surfaces = {}  # Shape ID -> (Surface, hotspot)
+        self.saved = None  # (rect, screen size, pixels under the pointer)
+        self.drawn = None  # Pointer state currently on screen
+
+    def surface(self, shape_id):
+        if shape_id not in self.surfaces:
+            image = cursor_images.get(shape_id)
+            if image is None:
+                return self.surfaces.setdefault(None, default_cursor())
+            pixels, size, hotspot = image
+            self.surfaces[shape_id] = (pygame.image.frombytes(pixels, size, 'RGBA'), hotspot)
+        return self.surfaces[shape_id]
+
+    def state(self):
+        """Window position and shape ID of the pointer to draw, or None to draw none"""
+        if remote_cursor is None:
+            return None
+        x, y, shape_id, visible = remote_cursor
+        if time.time() - last_local_motion < LOCAL_CURSOR_HOLD:
+            # The local mouse is ahead of the remote pointer, which will catch up to it
+            local = pygame.mouse.get_pos()
+            if display_to_remote(*local) is not None:
+                return local, shape_id
+        if not visible:
+            return None
+        display_width, display_height, offset_x, offset_y = get_display_dimensions(*screen.get_size())
+        return (offset_x + int(x * display_width), offset_y + int(y * display_height)), shape_id
 
-def recvmsg(socket):
-    size_data = recvall(socket, 4)
-    if not size_data:
-        return None
-    size = struct.unpack(">L", size_data)[0]
-    data = recvall(socket, size)
-    if data is None:
-        return None
-    key_data = json.loads(data.decode())
-    return key_data
+    def erase(self):
+        """Put back the pixels under the pointer; returns the rectangle to update"""
+        saved, self.saved, self.drawn = self.saved, None, None
+        if saved is None or saved[1] != screen.get_size():
+            return None
+        rect, _, pixels = saved
+        screen.blit(pixels, rect)
+        return rect
+
+    def draw(self, state):
+        """Draw the pointer on a screen it is not on yet; returns the rectangle to update"""
+        self.saved, self.drawn = None, state
+        if state is None:
+            return None
+        (x, y), shape_id = state
+        surface, (hotspot_x, hotspot_y) = self.surface(shape_id)
+        rect = surface.get_rect(topleft=(x - hotspot_x, y - hotspot_y)).clip(screen.get_rect())
+        if not rect.width or not rect.height:
+            return None
+        self.saved = (rect, screen.get_size(), screen.subsurface(rect).copy())
+        screen.blit(surface, (x - hotspot_x, y - hotspot_y))
+        return rect
 
 
-def recvall(sock, size):
-    data = b''
-    while len(data) < size:
-        packet = sock.recv(min(size - len(data), 4096))
-        if not packet:
-            return None
-        data += packet
-    return data
+cursor_overlay = CursorOverlay()
 
 
 # pygame key event to name mapping
@@ -101,14 +275,7 @@ def handle_key_event(key, event_type):
         toggle_fullscreen()
         return
 
-    try:
-        key_data = {
-            'type': event_type,
-            'key': key_name
-        }
-        sendmsg(input_socket, key_data)
-    except Exception as e:
-        print(f"Error sending key {event_type}: {e}")
+    input_batch.add(protocol.encode_key(event_type, key_name))
 
 
 def toggle_fullscreen():
@@ -136,34 +303,36 @@ def toggle_fullscreen():
     pygame.display.flip()
 
 
+def display_to_remote(x, y, clamp=False):
+    """Map a window position to normalized (0.0-1.0) remote coordinates, or None outside the display area"""
+    screen_width, screen_height = screen.get_size()
+
+    # Get the current display area dimensions (accounting for letterboxing)
+    display_width, display_height, offset_x, offset_y = get_display_dimensions(screen_width, screen_height)
+
+    # Normalize position within the display area (0.0 to 1.0)
+    norm_x = (x - offset_x) / display_width
+    norm_y = (y - offset_y) / display_height
+    if clamp:
+        return min(max(norm_x, 0.0), 1.0), min(max(norm_y, 0.0), 1.0)
+    if 0.0 <= norm_x < 1.0 and 0.0 <= norm_y < 1.0:
+        return norm_x, norm_y
+    return None
+
+
 def handle_mouse_motion(x, y):
     """Handle mouse motion events and send normalized coordinates to the controlled client"""
-    global screen, remote_width, remote_height, input_socket
+    global screen, remote_width, remote_height, input_socket, last_local_motion
 
     if screen is None or input_socket is None:
         return
 
-    screen_width, screen_height = screen.get_size()
-
-    # Get the current display area dimensions (accounting for letterboxing)
-    display_width, display_height, offset_x, offset_y = get_display_dimensions(screen_width, screen_height)
-
     # Check if mouse is in the display area
-    if (offset_x <= x < offset_x + display_width and offset_y <= y < offset_y + display_height):
-        # Normalize position within the display area (0.0 to 1.0)
-        norm_x = (x - offset_x) / display_width
-        norm_y = (y - offset_y) / display_height
-
-        # Send normalized mouse position
-        try:
-            mouse_data = {
-                'type': 'move',
-                'x': norm_x,
-                'y': norm_y
-            }
-            sendmsg(input_socket, mouse_data)
-        except Exception as e:
-            print(f"Error sending mouse position: {e}")
+    position = display_to_remote(x, y)
+    if position is not None:
+        # Queue normalized mouse position, only the latest one per tick is sent
+        input_batch.add_move(*position)
+        last_local_motion = time.time()
 
 
 def handle_mouse_button(button, pressed):
@@ -181,16 +350,65 @@ def handle_mouse_button(button, pressed):
 
     button_name = button_map.get(button)
     if button_name:
-        try:
-            mouse_data = {
-                'type': 'click',
-                'button': button_name,
-                'action': 'press' if pressed else 'release'
-            }
-            sendmsg(input_socket, mouse_data)
-            print(f"Mouse {button_name} {mouse_data['action']} sent")
-        except Exception as e:
-            print(f"Error sending mouse click: {e}")
+        input_batch.add(protocol.encode_click(button_name, pressed))
+        print(f"Mouse {button_name} {'press' if pressed else 'release'} queued")
+
+
+def report_viewer_size(size):
+    """
+    Tell the controlled client how many pixels this window can show, so it scales frames down
+    before encoding instead of this side throwing the extra pixels away; reported once a
+    resize or fullscreen switch has settled
+    """
+    global reported_size, pending_size, pending_since
+
+    if size == reported_size:
+        return
+    now = time.time()
+    if size != pending_size:
+        pending_size, pending_since = size, now
+    if reported_size is not None and now - pending_since < VIEWER_SIZE_DELAY:
+        return
+    reported_size = size
+    try:
+        with send_lock:
+            sendmsg(screen_socket, {'type': 'viewer_size', 'width': size[0], 'height': size[1]})
+    except OSError as e:
+        print(f"Error reporting the window size: {e}")
+
+
+def select_remote_region(monitor, region=None):
+    """Ask the controlled client to capture another monitor, or only part of one"""
+    message = {'type': 'select_region', 'monitor': monitor}
+    if region is not None:
+        message['region'] = region
+    try:
+        with send_lock:
+            sendmsg(screen_socket, message)
+    except OSError as e:
+        print(f"Error selecting capture region: {e}")
+
+
+def handle_region_drag(event):
+    """
+    Turn a drag over the remote screen into a zoom onto that region; consumes the mouse
+    events while a selection is in progress so none of them reach the controlled client
+    """
+    global region_select
+
+    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and region_select == 'armed':
+        region_select = display_to_remote(*event.pos) or 'armed'
+    elif event.type == pygame.MOUSEBUTTONUP and event.button == 1 and region_select != 'armed':
+        (x0, y0), (x1, y1) = region_select, display_to_remote(*event.pos, clamp=True)
+        region_select = None
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        if x1 - x0 < 0.02 or y1 - y0 < 0.02:
+            print("Region selection cancelled")
+            return
+        # The drag is relative to the current view, the request to the whole monitor
+        rx, ry, rw, rh = remote_region
+        select_remote_region(remote_monitor, [rx + x0 * rw, ry + y0 * rh, (x1 - x0) * rw, (y1 - y0) * rh])
 
 
 def get_display_dimensions(screen_width, screen_height):
@@ -198,8 +416,12 @@ def get_display_dimensions(screen_width, screen_height):
     Calculate the dimensions of the display area, accounting for letterboxing
     Returns (display_width, display_height, offset_x, offset_y)
     """
-    global remote_width, remote_height
+    return letterbox(screen_width, screen_height, remote_width, remote_height)
+
 
+@functools.lru_cache(maxsize=16)
+def letterbox(screen_width, screen_height, remote_width, remote_height):
+    """Letterbox geometry, cached since it only changes with the window or remote screen size"""
     # Calculate aspect ratios
     screen_aspect = screen_width / screen_height
     remote_aspect = remote_width / remote_height
@@ -220,11 +442,440 @@ def get_display_dimensions(screen_width, screen_height):
     return display_width, display_height, offset_x, offset_y
 
 
+def decode_tile(data, scale):
+    tile = Image.open(io.BytesIO(data))
+    if scale > 1:
+        # Let the JPEG decoder skip the detail the window cannot show anyway
+        tile.draft('RGB', (max(1, tile.width // scale), max(1, tile.height // scale)))
+    tile.load()
+    return tile
+
+
+def apply_tile_frame(data):
+    """
+    Composite a tile frame onto the persistent framebuffer
+    Large frames, such as keyframes sent as stripes, are decoded on several cores; Pillow
+    releases the GIL while decoding
+    Returns True if the framebuffer changed and should be redrawn
+    """
+    global framebuffer, tile_cache_seq, awaiting_keyframe, last_keyframe_request, copy_resampled
+
+    _, flags, seq, _, _, width, height, rect_count = protocol.FRAME_HEADER.unpack_from(data)
+    scale = decode_scale
+    scaled_size = (-(-width // scale), -(-height // scale))
+
+    resized = False
+    if flags & protocol.FLAG_KEYFRAME:
+        if framebuffer is None or framebuffer.size != scaled_size:
+            framebuffer = Image.new('RGB', scaled_size)
+            resized = True
+    elif framebuffer is None or framebuffer.size != scaled_size:
+        # Deltas are meaningless until the next full frame arrives
+        return False
+
+    capacity, tile_size = tile_cache_size
+    if flags & protocol.FLAG_KEYFRAME:
+        copy_resampled = False
+    if flags & protocol.FLAG_CACHE_RESET:
+        tile_cache.reset(capacity)
+    elif resized or tile_cache_seq is None or seq != (tile_cache_seq + 1) & 0xFFFFFFFF:
+        # A frame went missing, e.g. deltas the relay dropped for a periodic keyframe, or the
+        # cached tiles have the wrong scale: the tile IDs no longer match until the next
+        # resynchronizing keyframe, so ask for one rather than show stale tiles until then;
+        # the relay already asked for one when this viewer joined
+        tile_cache.reset(0)
+        if (capacity and tile_cache_seq is not None and
+                time.time() - last_keyframe_request >= KEYFRAME_REQUEST_INTERVAL):
+            last_keyframe_request = time.time()
+            request_keyframe()
+    tile_cache_seq = seq
+
+    offset = protocol.FRAME_HEADER.size
+    if flags & protocol.FLAG_COPY:
+        # Scrolled content: move what the framebuffer already shows, the tiles fill in the rest
+        x, y, w, h, src_x, src_y = protocol.COPY_RECT.unpack_from(data, offset)
+        offset += protocol.COPY_RECT.size
+        box = (x // scale, y // scale, -(-(x + w) // scale), -(-(y + h) // scale))
+        if (src_x - x) % scale or (src_y - y) % scale:
+            # The shift is not a whole number of framebuffer pixels; rounding it would misplace
+            # the content a little more with every frame, so resample it at the exact offset.
+            # Resampling blurs a little each time, so a keyframe is asked for once the screen settles
+            copy_resampled = True
+            moved = framebuffer.transform((box[2] - box[0], box[3] - box[1]), Image.AFFINE,
+                                          (1, 0, box[0] + (src_x - x) / scale, 0, 1, box[1] + (src_y - y) / scale),
+                                          Image.BILINEAR)
+        else:
+            moved = framebuffer.crop((box[0] + (src_x - x) // scale, box[1] + (src_y - y) // scale,
+                                      box[2] + (src_x - x) // scale, box[3] + (src_y - y) // scale))
+        framebuffer.paste(moved, box[:2])
+
+    if flags & protocol.FLAG_CACHED:
+        ref_count = protocol.CACHE_REFS.unpack_from(data, offset)[0]
+        offset += protocol.CACHE_REFS.size
+        missing = 0
+        for _ in range(ref_count):
+            x, y, tile_id = protocol.CACHE_REF.unpack_from(data, offset)
+            offset += protocol.CACHE_REF.size
+            tile = tile_cache.get(tile_id)
+            if tile is None:
+                missing += 1
+            else:
+                framebuffer.paste(tile, (x // scale, y // scale))
+        viewer_stats.count('tile_cache_hits', ref_count - missing)
+        if missing:
+            # Only possible after a lost frame; the picture is wrong until a keyframe repairs it
+            viewer_stats.count('tile_cache_misses', missing)
+            if not awaiting_keyframe:
+                awaiting_keyframe = True
+                last_keyframe_request = time.time()
+                request_keyframe()
+
+    rects = []
+    positions = []
+    jpegs = []
+    area = 0
+    for _ in range(rect_count):
+        x, y, w, h, size = protocol.FRAME_RECT.unpack_from(data, offset)
+        offset += protocol.FRAME_RECT.size
+        rects.append((x, y, w, h))
+        positions.append((x // scale, y // scale))
+        jpegs.append(data[offset:offset + size])
+        area += w * h
+        offset += size
+
+    if rect_count > 1 and area >= PARALLEL_DECODE_AREA:
+        tiles = decode_executor.map(decode_tile, jpegs, [scale] * rect_count)
+    else:
+        tiles = (decode_tile(jpeg, scale) for jpeg in jpegs)
+    for position, tile in zip(positions, tiles):
+        framebuffer.paste(tile, position)
+
+    # Cache the whole tiles just decoded, in the order the sender added them to its cache
+    if tile_cache.capacity:
+        for x, y in whole_tiles(rects, tile_size):
+            tile_cache.add(framebuffer.crop((x // scale, y // scale, (x + tile_size) // scale,
+                                             (y + tile_size) // scale)))
+    return True
+
+
+def open_video_decoder(codec):
+    """Set up decoding for the screen codec announced in screen_info"""
+    global video_decoder
+
+    video_decoder = None
+    if codec == 'jpeg':
+        return
+    if av is None:
+        print(f"Remote screen uses {codec}, which requires PyAV (pip install av)")
+        return
+    video_decoder = av.CodecContext.create(codec, 'r')
+    print(f"Decoding {codec} video stream")
+
+
+def apply_video_frame(data):
+    """
+    Decode a video frame into the framebuffer
+    Returns True if the framebuffer changed and should be redrawn
+    """
+    global framebuffer
+
+    _, flags, seq, _, _, width, height = protocol.VIDEO_HEADER.unpack_from(data)
+
+    if video_decoder is None:
+        return False
+    if not flags & protocol.FLAG_KEYFRAME and framebuffer is None:
+        # Predicted frames are meaningless until the first keyframe arrives
+        return False
+
+    frames = video_decoder.decode(av.Packet(bytes(data[protocol.VIDEO_HEADER.size:])))
+    if not frames:
+        return False
+    # Convert straight to the reduced size, the codec's scaler is much cheaper than PIL's
+    framebuffer = frames[-1].to_image(width=-(-width // decode_scale), height=-(-height // decode_scale))
+    return True
+
+
+def choose_decode_scale(width, height):
+    """Largest reduction that still leaves at least one decoded pixel per window pixel"""
+    display_width, display_height = get_display_dimensions(*window_size)[:2]
+    scale = 1
+    while (scale < MAX_DECODE_SCALE and width // (scale * 2) >= display_width and
+           height // (scale * 2) >= display_height):
+        scale *= 2
+    return scale
+
+
+def scale_frame(image, resample):
+    """Scale a frame to the letterboxed display area, returning (RGB bytes, size, offset)"""
+    display_width, display_height, offset_x, offset_y = get_display_dimensions(*window_size)
+
+    # Resize image to the display area dimensions, preserving aspect ratio
+    if image.size != (display_width, display_height):
+        image = image.resize((display_width, display_height), resample)
+    return image.tobytes(), image.size, (offset_x, offset_y)
+
+
+def request_keyframe():
+    try:
+        with send_lock:
+            send_message(screen_socket, protocol.encode_keyframe_request())
+    except Exception as e:
+        print(f"Error requesting keyframe: {e}")
+
+
+def apply_screen_frame(data, superseded):
+    """
+    Apply one tile or video frame in order and publish it for the render loop
+    A frame that is already superseded by a newer one is applied but not scaled, since it
+    would never be seen; returns True if the frame was published
+    """
+    global latest_frame, decode_scale, last_frame_seq, awaiting_keyframe, last_keyframe_request
+
+    kind = protocol.message_type(data)
+    viewer_stats.count('frames_received')
+    viewer_stats.count('bytes_received', len(data))
+
+    # Composite changed tiles onto the persistent framebuffer, or decode the video frame
+    frame_seq, capture_time, inputs_applied, width, height = protocol.frame_info(data)
+    keyframe = protocol.is_keyframe(data)
+    if not keyframe:
+        if last_frame_seq is not None and not seq_newer(frame_seq, last_frame_seq):
+            return False  # Already seen over the other transport while switching to UDP
+        if awaiting_keyframe:
+            # A frame was lost, deltas cannot be applied until the next full frame
+            if time.time() - last_keyframe_request >= KEYFRAME_REQUEST_INTERVAL:
+                last_keyframe_request = time.time()
+                request_keyframe()
+            viewer_stats.count('frames_skipped')
+            return False
+    awaiting_keyframe = False
+    last_frame_seq = frame_seq
+
+    # Only meaningful when both machines keep their clocks in sync
+    viewer_stats.record('capture_to_receive', time.time() - capture_time)
+    if window_size is not None:
+        scale = choose_decode_scale(width, height)
+        if scale != decode_scale:
+            decode_scale = scale
+            if kind == protocol.MSG_FRAME:
+                # The framebuffer has to be rebuilt at the new size from a full frame
+                request_keyframe()
+
+    decode_start = time.time()
+    if kind == protocol.MSG_VIDEO:
+        changed = apply_video_frame(data)
+    else:
+        changed = apply_tile_frame(data)
+    viewer_stats.record('decode', time.time() - decode_start)
+    if not changed:
+        send_frame_ack(frame_seq)
+        return False
+    if window_size is None or superseded:
+        # A newer frame has already arrived, so this one would never be seen
+        viewer_stats.count('frames_skipped')
+        return False
+
+    scale_start = time.time()
+    scaled = scale_frame(framebuffer, Image.BILINEAR)
+    viewer_stats.record('scale', time.time() - scale_start)
+    frame = (frame_seq, capture_time, inputs_applied, time.time()) + scaled
+    with frame_lock:
+        latest_frame = frame
+    return True
+
+
+def on_frame_lost(count):
+    """Frames went missing on the datagram transport; ask for a keyframe to resynchronize"""
+    global awaiting_keyframe, last_keyframe_request
+
+    viewer_stats.count('frames_lost', count)
+    awaiting_keyframe = True
+    last_keyframe_request = time.time()
+    request_keyframe()
+
+
+def restart_frame_sequence():
+    """
+    Forget the frame numbering once the controlled client announces its screen again
+    Over UDP its first keyframe may have overtaken screen_info and been dropped as a late
+    fragment of the old sequence, so another one is asked for
+    """
+    global last_frame_seq, awaiting_keyframe, last_keyframe_request
+
+    last_frame_seq = None
+    awaiting_keyframe = True
+    last_keyframe_request = time.time()
+    request_keyframe()
+
+
+def open_datagram_link(message):
+    """Register a UDP socket with the relay so screen frames can arrive as datagrams"""
+    link = DatagramLink(SERVER_HOST, message['port'], message['token'])
+    if not link.handshake():
+        print("UDP screen transport unavailable, staying on TCP")
+        link.close()
+        return None
+    print("Receiving screen frames over UDP")
+    link.sock.setblocking(False)
+    return link
+
+
+def read_datagrams(link, reassembler):
+    """Drain the UDP socket and return the (frame, frames lost before it) it completed"""
+    frames = []
+    while True:
+        try:
+            data = link.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            break
+        except OSError:
+            break  # ICMP error from an earlier datagram, the socket itself is still usable
+        if protocol.message_type(data) != protocol.MSG_FRAGMENT:
+            continue
+        result = reassembler.add(data)
+        if result is not None:
+            frames.append(result)
+    return frames
+
+
+def receive_screen(screen_reader):
+    """
+    Receive and decode screen messages off the UI thread
+    Every frame is applied in order, since deltas build on each other, but only the newest
+    one is scaled and published; the render loop shows whatever is current at its own tick
+    Frames in motion are scaled with BILINEAR, and redrawn with LANCZOS once the screen settles
+    With the UDP transport frames arrive as datagrams, control messages stay on the TCP connection
+    """
+    global latest_frame, last_keyframe_request, remote_cursor, tile_cache_size
+
+    sharp_geometry = None  # Window geometry of the last LANCZOS redraw
+    link = None
+    reassembler = Reassembler()
+    try:
+        while True:
+            if not screen_reader.pending:
+                sockets = [screen_reader.sock] + ([link.sock] if link else [])
+                readable = select.select(sockets, [], [], IDLE_REDRAW_DELAY)[0]
+                if link is not None:
+                    link.keepalive(time.time())
+
+                if not readable:
+                    geometry = (window_size, remote_width, remote_height)
+                    if framebuffer is not None and window_size is not None and geometry != sharp_geometry:
+                        sharp_geometry = geometry
+                        frame = (None, None, None, time.time()) + scale_frame(framebuffer, Image.LANCZOS)
+                        with frame_lock:
+                            latest_frame = frame
+                    if awaiting_keyframe and time.time() - last_keyframe_request >= KEYFRAME_REQUEST_INTERVAL:
+                        # The keyframe itself may have been lost
+                        last_keyframe_request = time.time()
+                        request_keyframe()
+                    elif copy_resampled and time.time() - last_keyframe_request >= KEYFRAME_REQUEST_INTERVAL:
+                        # Scrolling stopped; replace the content blurred by fractional copies
+                        last_keyframe_request = time.time()
+                        request_keyframe()
+                    continue
+
+                if link is not None and link.sock in readable:
+                    frames = read_datagrams(link, reassembler)
+                    for index, (data, lost) in enumerate(frames):
+                        if lost and not protocol.is_keyframe(data):
+                            on_frame_lost(lost)
+                        try:
+                            if apply_screen_frame(data, index < len(frames) - 1):
+                                sharp_geometry = None
+                        except Exception as e:
+                            print(f"Error processing image: {e}")
+                    if screen_reader.sock not in readable:
+                        continue
+
+            # Receive the next message straight into the reader's reusable buffers
+            data = screen_reader.read_message()
+            if data is None:
+                break
+
+            kind = protocol.message_type(data)
+            if kind == protocol.MSG_CONTROL:
+                try:
+                    message = protocol.decode_control(data)
+                except ValueError as e:
+                    print(f"Invalid control message: {e}")
+                    continue
+                if not isinstance(message, dict):
+                    continue
+                if message.get('type') == 'screen_info':
+                    # Frames after this one may already use the new codec
+                    open_video_decoder(message.get('codec', 'jpeg'))
+                    tile_cache_size = (message.get('tile_cache', 0), message.get('tile_size', 64))
+                    # It may come from a restarted controlled client, which numbers frames from zero again
+                    reassembler = Reassembler()
+                    if link is not None:
+                        restart_frame_sequence()
+                elif message.get('type') == 'udp_setup':
+                    link = open_datagram_link(message)
+                    reassembler = Reassembler()
+                    continue
+                control_messages.put(message)
+                continue
+            if kind == protocol.MSG_CURSOR_POSITION:
+                remote_cursor = protocol.decode_cursor_position(data)
+                viewer_stats.count('cursor_updates')
+                continue
+            if kind == protocol.MSG_CURSOR_SHAPE:
+                try:
+                    shape_id, hotspot_x, hotspot_y, png = protocol.decode_cursor_shape(data)
+                    image = Image.open(io.BytesIO(png)).convert('RGBA')
+                    cursor_images[shape_id] = (image.tobytes(), image.size, (hotspot_x, hotspot_y))
+                except Exception as e:
+                    print(f"Error decoding cursor shape: {e}")
+                continue
+            if kind not in (protocol.MSG_FRAME, protocol.MSG_VIDEO):
+                continue
+
+            try:
+                superseded = any(protocol.is_screen_frame(m) for m in screen_reader.pending)
+                if apply_screen_frame(data, superseded):
+                    sharp_geometry = None
+            except Exception as e:
+                print(f"Error processing image: {e}")
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, OSError) as e:
+        print(f"Connection error: {e}")
+    finally:
+        if link is not None:
+            link.close()
+        control_messages.put(None)
+
+
+def draw_stats_overlay(font):
+    """Draw the controller's rolling statistics in the top left corner of the window"""
+    lines = viewer_stats.summary_lines() or ["No statistics yet"]
+    surfaces = [font.render(line, True, (255, 255, 255)) for line in lines]
+    width = max(surface.get_width() for surface in surfaces) + 10
+    height = sum(surface.get_height() for surface in surfaces) + 10
+    background = pygame.Surface((width, height))
+    background.set_alpha(180)
+    screen.blit(background, (0, 0))
+    y = 5
+    for surface in surfaces:
+        screen.blit(surface, (5, y))
+        y += surface.get_height()
+
+
+def send_frame_ack(seq):
+    """Acknowledge a displayed frame so the controlled client can adapt its bitrate"""
+    try:
+        with send_lock:
+            send_message(screen_socket, protocol.encode_frame_ack(seq))
+    except Exception as e:
+        print(f"Error sending frame acknowledgement: {e}")
+
+
 def main():
     global screen, input_socket, screen_socket, remote_width, remote_height, original_size, fullscreen_mode
+    global window_size, latest_frame, show_stats, remote_monitor, remote_monitors, remote_region, region_select
 
-    screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    input_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    screen_socket = create_socket('screen')
+    input_socket = create_socket('input')
 
     try:
         print(f"Connecting to server at {SERVER_HOST}...")
@@ -232,8 +883,10 @@ def main():
         input_socket.connect((SERVER_HOST, INPUT_PORT))
 
         print("Connected to server successfully")
-        sendmsg(screen_socket, 'controller_screen')
-        sendmsg(input_socket, 'controller_input')
+        sendmsg(screen_socket, {'client_type': 'controller_screen', 'session': SESSION_ID,
+                                'transport': SCREEN_TRANSPORT})
+        sendmsg(input_socket, {'client_type': 'controller_input', 'session': SESSION_ID})
+        screen_reader = FrameReader(screen_socket)
 
         print("Waiting for a controlled client to connect...")
 
@@ -263,12 +916,19 @@ def main():
 
         connection_active = False
         clock = pygame.time.Clock()
+        stats_font = pygame.font.Font(None, 22)
 
         # Start tracking mouse movement with pygame events
         pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP,
                                   pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP])
 
-        while True:
+        # Receive and decode on a worker so large frames never stall event handling
+        receive_thread = threading.Thread(target=receive_screen, args=(screen_reader,))
+        receive_thread.daemon = True
+        receive_thread.start()
+
+        running = True
+        while running:
             # Process all pygame events
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -278,6 +938,17 @@ def main():
                     # Handle key press events
                     if event.key == pygame.K_F11:
                         toggle_fullscreen()
+                    elif event.key == pygame.K_F3:
+                        show_stats = not show_stats
+                    elif event.key == pygame.K_F7:
+                        # Back to the whole monitor
+                        select_remote_region(remote_monitor)
+                    elif event.key == pygame.K_F8:
+                        # Cycle through the remote monitors, then the whole desktop
+                        select_remote_region((remote_monitor + 1) % (remote_monitors + 1))
+                    elif event.key == pygame.K_F9:
+                        region_select = 'armed'
+                        print("Drag over the remote screen to zoom into that region")
                     elif event.key == pygame.K_ESCAPE and fullscreen_mode:
                         toggle_fullscreen()
                     else:
@@ -286,12 +957,16 @@ def main():
 
                 elif event.type == pygame.KEYUP:
                     # Handle key release events
-                    if event.key not in [pygame.K_F11, pygame.K_ESCAPE]:
+                    if event.key not in [pygame.K_F11, pygame.K_F3, pygame.K_F7, pygame.K_F8, pygame.K_F9,
+                                         pygame.K_ESCAPE]:
                         # Forward key releases to controlled client
                         handle_key_event(event.key, 'release')
 
                 # Handle mouse events if connection is active
-                if connection_active:
+                if region_select is not None:
+                    if event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+                        handle_region_drag(event)
+                elif connection_active:
                     if event.type == pygame.MOUSEMOTION:
                         handle_mouse_motion(event.pos[0], event.pos[1])
 
@@ -301,99 +976,103 @@ def main():
                     elif event.type == pygame.MOUSEBUTTONUP:
                         handle_mouse_button(event.button, False)
 
-            # Process incoming screen data
+            # Send everything this tick produced in a single write
             try:
-                # Try to receive frame size
+                input_batch.flush(input_socket)
+                input_batch.read_acks(input_socket)
+            except Exception as e:
+                print(f"Error sending input: {e}")
+
+            # Apply control messages handed over by the receive thread
+            while True:
                 try:
-                    frame_size_data = recvall(screen_socket, 4)
-                    if not frame_size_data:
-                        time.sleep(0.01)
-                        continue
-                except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
-                    print(f"Connection error: {e}")
+                    message = control_messages.get_nowait()
+                except queue.Empty:
                     break
+                if message is None:
+                    print("Server disconnected. Exiting...")
+                    running = False
+                    break
+                if message.get('type') == 'connection_status':
+                    if message.get('status') == 'complete':
+                        print("Connection to controlled client established!")
+                        connection_active = True
+                elif message.get('type') == 'screen_info':
+                    remote_width = message.get('width', 1920)
+                    remote_height = message.get('height', 1080)
+                    remote_monitor = message.get('monitor', 0)
+                    remote_monitors = message.get('monitors', 0)
+                    remote_region = tuple(message.get('region', (0.0, 0.0, 1.0, 1.0)))
+
+                    print(f"Remote screen size: {remote_width}x{remote_height}")
+
+                    # If not already in fullscreen, update the window with the right aspect ratio
+                    if not fullscreen_mode:
+                        # Calculate aspect ratio
+                        aspect_ratio = remote_width / remote_height
+
+                        # Determine new window size based on aspect ratio
+                        # but maintain same window area for similar pixel density
+                        current_area = original_size[0] * original_size[1]
+                        new_height = int((current_area / aspect_ratio) ** 0.5)
+                        new_width = int(new_height * aspect_ratio)
+
+                        # Update original size and recreate window
+                        original_size = (new_width, new_height)
+                        screen = pygame.display.set_mode(original_size)
+
+                    pygame.display.set_caption(
+                        f"Remote Control - Controller View ({remote_width}x{remote_height})")
+                    connection_active = True
+
+            # Tell the receive thread what size to scale frames to
+            window_size = screen.get_size()
+            report_viewer_size(window_size)
+
+            # The remote pointer is drawn locally, hide ours while it is over the remote screen
+            mouse_visible = (remote_cursor is None or region_select is not None or
+                             display_to_remote(*pygame.mouse.get_pos()) is None)
+            if mouse_visible != pygame.mouse.get_visible():
+                pygame.mouse.set_visible(mouse_visible)
+            cursor_state = cursor_overlay.state()
+
+            # Show the newest decoded frame; older ones were already skipped
+            with frame_lock:
+                frame, latest_frame = latest_frame, None
+            if frame is not None:
+                seq, capture_time, inputs_applied, published, pixels, size, offset = frame
+                try:
+                    blit_start = time.time()
+
+                    # Clear screen with black
+                    screen.fill((0, 0, 0))
+
+                    # Blit the image with calculated offsets to maintain aspect ratio
+                    screen.blit(pygame.image.frombuffer(pixels, size, 'RGB'), offset)
+                    if show_stats:
+                        draw_stats_overlay(stats_font)
+                    cursor_overlay.draw(cursor_state)
+
+                    # Update the display
+                    pygame.display.flip()
+
+                    displayed = time.time()
+                    viewer_stats.record('blit', displayed - blit_start)
+                    viewer_stats.record('publish_to_display', displayed - published)
+
+                    # Let the controlled client measure end-to-end latency
+                    if seq is not None:
+                        send_frame_ack(seq)
+                        viewer_stats.count('frames_displayed')
+                        viewer_stats.record('capture_to_display', displayed - capture_time)
+                        input_batch.on_frame_shown(inputs_applied)
                 except Exception as e:
-                    print(f"Error receiving frame size: {e}")
-                    time.sleep(0.01)
-                    continue
-
-                frame_size = struct.unpack(">L", frame_size_data)[0]
-                data = recvall(screen_socket, frame_size)
-
-                if data:
-                    try:
-                        # Try to interpret data as JSON
-                        message = json.loads(data.decode())
-                        if isinstance(message, dict):
-                            if message.get('type') == 'connection_status':
-                                if message.get('status') == 'complete':
-                                    print("Connection to controlled client established!")
-                                    connection_active = True
-                            elif message.get('type') == 'screen_info':
-                                remote_width = message.get('width', 1920)
-                                remote_height = message.get('height', 1080)
-
-                                print(f"Remote screen size: {remote_width}x{remote_height}")
-
-                                # If not already in fullscreen, update the window with the right aspect ratio
-                                if not fullscreen_mode:
-                                    # Calculate aspect ratio
-                                    aspect_ratio = remote_width / remote_height
-
-                                    # Determine new window size based on aspect ratio
-                                    # but maintain same window area for similar pixel density
-                                    current_area = original_size[0] * original_size[1]
-                                    new_height = int((current_area / aspect_ratio) ** 0.5)
-                                    new_width = int(new_height * aspect_ratio)
-
-                                    # Update original size and recreate window
-                                    original_size = (new_width, new_height)
-                                    screen = pygame.display.set_mode(original_size)
-
-                                pygame.display.set_caption(
-                                    f"Remote Control - Controller View ({remote_width}x{remote_height})")
-                                connection_active = True
-                        continue
-                    except (json.JSONDecodeError, UnicodeDecodeError):
-                        # Not JSON data, treat as image data
-                        pass
-
-                    try:
-                        # Process image data
-                        image_stream = io.BytesIO(data)
-                        image = Image.open(image_stream)
-
-                        # Get the current screen size
-                        screen_width, screen_height = screen.get_size()
-
-                        # Calculate display area dimensions and offsets (for letterboxing)
-                        display_width, display_height, offset_x, offset_y = get_display_dimensions(
-                            screen_width, screen_height)
-
-                        # Resize image to the display area dimensions, preserving aspect ratio
-                        image = image.resize((display_width, display_height), Image.LANCZOS)
-
-                        # Convert to pygame surface
-                        frame = pygame.image.fromstring(image.tobytes(), image.size, image.mode)
-
-                        # Clear screen with black
-                        screen.fill((0, 0, 0))
-
-                        # Blit the image with calculated offsets to maintain aspect ratio
-                        screen.blit(frame, (offset_x, offset_y))
-
-                        # Update the display
-                        pygame.display.flip()
-                    except Exception as e:
-                        print(f"Error processing image: {e}")
-                        continue
-            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
-                print(f"Connection error: {e}")
-                print("Server disconnected. Exiting...")
-                break
-            except Exception as e:
-                print(f"Unexpected error: {e}")
-                continue
+                    print(f"Error displaying frame: {e}")
+            elif cursor_state != cursor_overlay.drawn:
+                # Only the pointer moved: redraw the two rectangles it left and entered
+                rects = [cursor_overlay.erase(), cursor_overlay.draw(cursor_state)]
+                pygame.display.update([rect for rect in rects if rect])
+            viewer_stats.maybe_dump()
 
             # Limit to 60 FPS to prevent excessive CPU usage
             clock.tick(60)
@@ -404,6 +1083,7 @@ def main():
         print(f"Error: {e}")
     finally:
         # Clean up resources
+        viewer_stats.dump()
         pygame.quit()
         try:
             screen_socket.close()
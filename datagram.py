@@ -0,0 +1,113 @@
+import socket
+
+import protocol
+from connection import create_datagram_socket
+
+# Datagram screen transport configuration
+FRAGMENT_PAYLOAD = 1200  # Frame bytes per datagram, small enough to avoid IP fragmentation
+MAX_PARTIAL_FRAMES = 8  # Incomplete frames kept while waiting for their missing fragments
+HELLO_ATTEMPTS = 5  # Hellos sent before giving up on UDP and staying on TCP
+HELLO_TIMEOUT = 0.2  # Seconds to wait for the relay to echo each hello
+HELLO_INTERVAL = 2.0  # Seconds between hellos that keep NAT mappings open
+
+
+def seq_newer(seq, other):
+    """True if frame sequence number seq comes after other, allowing for wraparound"""
+    return seq != other and (seq - other) & 0xFFFFFFFF < 0x80000000
+
+
+def fragment(payload, token, seq):
+    """Split one screen frame message into datagrams"""
+    count = max(1, -(-len(payload) // FRAGMENT_PAYLOAD))
+    view = memoryview(payload)
+    return [protocol.FRAGMENT.pack(protocol.MSG_FRAGMENT, token, seq, index, count) +
+            view[index * FRAGMENT_PAYLOAD:(index + 1) * FRAGMENT_PAYLOAD]
+            for index in range(count)]
+
+
+class Reassembler:
+    """
+    Rebuilds screen frames from fragments that may arrive out of order, duplicated or not at all
+    Frames are returned in completion order; a frame still incomplete when a newer one completes
+    is given up on, and the number of frames skipped that way is reported with each frame
+    """
+
+    def __init__(self):
+        self.partial = {}  # seq -> [fragments, number received]
+        self.last_complete = None
+        self.lost = 0
+
+    def add(self, datagram):
+        """Return (frame, frames skipped since the previous one), or None while incomplete"""
+        _, _, seq, index, count = protocol.FRAGMENT.unpack_from(datagram)
+        if self.last_complete is not None and not seq_newer(seq, self.last_complete):
+            return None  # Late fragment of a frame that was completed or given up on
+        if index >= count:
+            return None
+
+        entry = self.partial.get(seq)
+        if entry is None:
+            entry = self.partial[seq] = [[None] * count, 0]
+            if len(self.partial) > MAX_PARTIAL_FRAMES:
+                oldest = max(self.partial, key=lambda other: (seq - other) & 0xFFFFFFFF)
+                del self.partial[oldest]
+        fragments = entry[0]
+        if index >= len(fragments) or fragments[index] is not None:
+            return None
+        fragments[index] = bytes(datagram[protocol.FRAGMENT.size:])
+        entry[1] += 1
+        if entry[1] < len(fragments):
+            return None
+
+        # Complete: every older frame still in progress will never be shown
+        del self.partial[seq]
+        for other in [other for other in self.partial if seq_newer(seq, other)]:
+            del self.partial[other]
+        skipped = 0 if self.last_complete is None else ((seq - self.last_complete) & 0xFFFFFFFF) - 1
+        self.last_complete = seq
+        self.lost += skipped
+        return b''.join(fragments), skipped
+
+
+class DatagramLink:
+    """UDP path to the relay for one screen connection, identified by the token the relay assigned"""
+
+    def __init__(self, host, port, token):
+        self.token = token
+        self.sock = create_datagram_socket()
+        self.sock.connect((host, port))
+        self.last_hello = 0.0
+
+    def handshake(self):
+        """Register with the relay; returns False if datagrams do not get through"""
+        self.sock.settimeout(HELLO_TIMEOUT)
+        try:
+            for _ in range(HELLO_ATTEMPTS):
+                self.sock.send(protocol.encode_udp_hello(self.token))
+                try:
+                    while True:
+                        data = self.sock.recv(65536)
+                        if protocol.message_type(data) == protocol.MSG_UDP_HELLO:
+                            return True
+                except socket.timeout:
+                    continue
+                except OSError:
+                    return False  # E.g. connection refused by a relay without UDP support
+            return False
+        finally:
+            self.sock.settimeout(None)
+
+    def keepalive(self, now):
+        if now - self.last_hello >= HELLO_INTERVAL:
+            self.last_hello = now
+            try:
+                self.sock.send(protocol.encode_udp_hello(self.token))
+            except OSError:
+                pass  # Best effort, the next hello tries again
+
+    def send_frame(self, payload, seq):
+        for datagram in fragment(payload, self.token, seq):
+            self.sock.send(datagram)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,136 @@
+import collections
+import struct
+
+# Every message on the wire is a 4-byte big-endian length followed by the payload
+HEADER = struct.Struct(">L")
+SCRATCH_SIZE = 64 * 1024  # Small messages are batched into one buffer of this size
+
+
+class MessageAssembler:
+    """
+    Incremental parser for length-prefixed messages that is filled in place with recv_into
+    Small messages share a scratch buffer so one read can pick up many of them; larger ones
+    are received straight into a buffer sized for the message so the payload is never copied
+
+    With reuse_buffers the returned payloads are memoryviews into buffers that are recycled
+    once the caller asks for the next buffer, so they must be consumed (or copied) before that.
+    Without it every payload owns its memory and may be kept, e.g. queued on several sockets.
+    """
+
+    def __init__(self, reuse_buffers=True, scratch_size=SCRATCH_SIZE):
+        self.reuse_buffers = reuse_buffers
+        self.scratch = bytearray(scratch_size)
+        self.start = 0  # First unparsed byte in scratch
+        self.end = 0  # End of received data in scratch
+        self.large = None  # Buffer the current large message is being received into
+        self.large_size = 0
+        self.large_filled = 0
+        self.spare = None  # Large buffer kept for the next large message when reusing
+
+    def get_buffer(self):
+        """Return the writable memoryview the next read should fill"""
+        if self.large is not None:
+            return memoryview(self.large)[self.large_filled:self.large_size]
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start and len(self.scratch) - self.end < len(self.scratch) // 4:
+            # Move the partial message to the front to make room
+            remaining = self.end - self.start
+            self.scratch[:remaining] = self.scratch[self.start:self.end]
+            self.start, self.end = 0, remaining
+        return memoryview(self.scratch)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Account for nbytes written into the last buffer and return the completed payloads"""
+        if self.large is not None:
+            self.large_filled += nbytes
+            if self.large_filled < self.large_size:
+                return []
+            return [self.take_large()]
+
+        messages = []
+        self.end += nbytes
+        while self.end - self.start >= HEADER.size:
+            size = HEADER.unpack_from(self.scratch, self.start)[0]
+            body_start = self.start + HEADER.size
+            available = self.end - body_start
+
+            if available >= size:
+                if self.reuse_buffers:
+                    messages.append(memoryview(self.scratch)[body_start:body_start + size])
+                else:
+                    messages.append(bytes(self.scratch[body_start:body_start + size]))
+                self.start = body_start + size
+            elif size > len(self.scratch) // 2:
+                # Receive the rest of this message directly into a buffer of its own
+                self.large = self.allocate(size)
+                self.large_size = size
+                self.large_filled = available
+                self.large[:available] = self.scratch[body_start:self.end]
+                self.start = self.end = 0
+                break
+            else:
+                break
+        return messages
+
+    def allocate(self, size):
+        if not self.reuse_buffers:
+            return bytearray(size)
+        if self.spare is None or len(self.spare) < size:
+            # Leave headroom so slowly growing frames do not reallocate every time
+            self.spare = bytearray(size + size // 4)
+        return self.spare
+
+    def take_large(self):
+        message = self.large
+        size = self.large_size
+        self.large = None
+        self.large_size = self.large_filled = 0
+        if self.reuse_buffers:
+            return memoryview(message)[:size]
+        return message
+
+
+class FrameReader:
+    """Blocking reader that returns one message payload at a time from a socket"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.assembler = MessageAssembler()
+        self.pending = collections.deque()
+
+    def read_message(self):
+        """
+        Return the next payload as a memoryview that stays valid until the following call,
+        or None when the connection was closed
+        """
+        while not self.pending:
+            nbytes = self.sock.recv_into(self.assembler.get_buffer())
+            if not nbytes:
+                return None
+            self.pending.extend(self.assembler.buffer_updated(nbytes))
+        return self.pending.popleft()
+
+
+def send_message(sock, payload):
+    """Send one length-prefixed message without concatenating header and payload"""
+    header = HEADER.pack(len(payload))
+    if not hasattr(sock, 'sendmsg'):
+        # No scatter/gather I/O on this platform (Windows)
+        sock.sendall(header + bytes(payload))
+        return
+
+    buffers = [memoryview(header)]
+    if len(payload):
+        buffers.append(memoryview(payload))
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
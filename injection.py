@@ -0,0 +1,186 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import queue
+import time
+
+# Injection configuration - configurable via environment variables
+# 'auto' uses XTest when an X display is available, pyautogui otherwise
+INPUT_BACKEND = os.getenv('INPUT_BACKEND', 'auto')
+
+log = logging.getLogger('injection')
+
+BUTTON_NUMBERS = {'left': 1, 'middle': 2, 'right': 3}
+
+# Key names sent by the controller -> X keysym names, for the few that differ
+KEYSYM_NAMES = {
+    'space': 'space', 'tab': 'Tab', 'enter': 'Return', 'backspace': 'BackSpace', 'delete': 'Delete',
+    'esc': 'Escape', 'caps lock': 'Caps_Lock', 'up': 'Up', 'down': 'Down', 'left': 'Left', 'right': 'Right',
+    'shift': 'Shift_L', 'ctrl': 'Control_L', 'alt': 'Alt_L',
+    ';': 'semicolon', ',': 'comma', '.': 'period', '/': 'slash', '\\': 'backslash', '-': 'minus',
+    '=': 'equal', '[': 'bracketleft', ']': 'bracketright', "'": 'apostrophe',
+    'page up': 'Prior', 'page down': 'Next', 'home': 'Home', 'end': 'End', 'insert': 'Insert',
+    'num lock': 'Num_Lock', 'scroll lock': 'Scroll_Lock', 'print screen': 'Print',
+}
+
+
+class PyAutoGuiBackend:
+    """Portable injection through pyautogui, without its default pause after every call"""
+
+    name = 'pyautogui'
+
+    def __init__(self):
+        import pyautogui
+        pyautogui.FAILSAFE = False  # Disable fail-safe (move mouse to corner to abort)
+        pyautogui.PAUSE = 0  # The default 0.1 s sleep after each call caps input at ten events a second
+        self.pyautogui = pyautogui
+
+    def move(self, x, y):
+        self.pyautogui.moveTo(x, y)
+
+    def button(self, button, pressed):
+        if pressed:
+            self.pyautogui.mouseDown(button=button)
+        else:
+            self.pyautogui.mouseUp(button=button)
+
+    def key(self, key, pressed):
+        if pressed:
+            self.pyautogui.keyDown(key)
+        else:
+            self.pyautogui.keyUp(key)
+
+    def flush(self):
+        pass
+
+
+class XTestBackend:
+    """
+    X11 injection through the XTEST extension: each event is one request on an open display
+    connection, flushed once per batch, instead of a pyautogui call per event
+    """
+
+    name = 'xtest'
+
+    def __init__(self):
+        x11_path, xtst_path = ctypes.util.find_library('X11'), ctypes.util.find_library('Xtst')
+        if x11_path is None or xtst_path is None:
+            raise OSError("libX11 or libXtst not found")
+        self.x11, self.xtst = ctypes.CDLL(x11_path), ctypes.CDLL(xtst_path)
+        self.x11.XOpenDisplay.restype = ctypes.c_void_p
+        self.x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        self.x11.XFlush.argtypes = [ctypes.c_void_p]
+        self.x11.XStringToKeysym.restype = ctypes.c_ulong
+        self.x11.XStringToKeysym.argtypes = [ctypes.c_char_p]
+        self.x11.XKeysymToKeycode.restype = ctypes.c_ubyte
+        self.x11.XKeysymToKeycode.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        self.xtst.XTestQueryExtension.argtypes = [ctypes.c_void_p] + [ctypes.POINTER(ctypes.c_int)] * 4
+        self.xtst.XTestFakeMotionEvent.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                                   ctypes.c_ulong]
+        self.xtst.XTestFakeButtonEvent.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+        self.xtst.XTestFakeKeyEvent.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+
+        self.display = self.x11.XOpenDisplay(None)
+        if not self.display:
+            raise OSError("cannot open the X display")
+        versions = [ctypes.c_int() for _ in range(4)]
+        if not self.xtst.XTestQueryExtension(self.display, *[ctypes.byref(v) for v in versions]):
+            self.x11.XCloseDisplay(self.display)
+            raise OSError("the X server has no XTEST extension")
+        self.keycodes = {}
+
+    def keycode(self, key):
+        if key not in self.keycodes:
+            name = KEYSYM_NAMES.get(key, key)
+            if len(name) > 1 and name[:1] == 'f' and name[1:].isdigit():
+                name = name.upper()  # f1 -> F1
+            keysym = self.x11.XStringToKeysym(name.encode())
+            self.keycodes[key] = self.x11.XKeysymToKeycode(self.display, keysym) if keysym else 0
+        return self.keycodes[key]
+
+    def move(self, x, y):
+        self.xtst.XTestFakeMotionEvent(self.display, -1, x, y, 0)
+
+    def button(self, button, pressed):
+        self.xtst.XTestFakeButtonEvent(self.display, BUTTON_NUMBERS[button], int(pressed), 0)
+
+    def key(self, key, pressed):
+        keycode = self.keycode(key)
+        if not keycode:
+            raise ValueError(f"no keycode for key {key!r}")
+        self.xtst.XTestFakeKeyEvent(self.display, keycode, int(pressed), 0)
+
+    def flush(self):
+        self.x11.XFlush(self.display)
+
+
+BACKENDS = {'pyautogui': PyAutoGuiBackend, 'xtest': XTestBackend}
+
+
+def open_backend(name=INPUT_BACKEND):
+    """Open the named injection backend; 'auto' prefers XTest and falls back to pyautogui"""
+    if name != 'auto':
+        return BACKENDS[name]()
+    if os.getenv('DISPLAY'):
+        try:
+            return XTestBackend()
+        except OSError as e:
+            log.info("XTest injection unavailable: %s", e)
+    return PyAutoGuiBackend()
+
+
+def coalesce_moves(records):
+    """Drop every mouse move that is immediately followed by another one"""
+    return [record for record, following in zip(records, records[1:] + [None])
+            if not (record.get('type') == 'move' and following is not None and following.get('type') == 'move')]
+
+
+class InputInjector:
+    """
+    Injects input records on a worker thread, so the input socket is always read promptly
+    Records that piled up while the previous ones were injected are taken as one batch, and
+    pointer moves in it collapse to the latest position; clicks and keys keep their order
+    """
+
+    def __init__(self, backend, dispatch, on_applied, stats=None):
+        self.backend = backend
+        self.dispatch = dispatch  # Injects one decoded record through the backend
+        self.on_applied = on_applied  # Called with the number of records handled, coalesced ones included
+        self.stats = stats
+        self.records = queue.Queue()
+
+    def submit(self, records):
+        for record in records:
+            self.records.put(record)
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                records = [self.records.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    records.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            start = time.time()
+            injected = coalesce_moves(records)
+            for record in injected:
+                try:
+                    self.dispatch(record)
+                except Exception as e:
+                    log.warning("Error injecting %s: %s", record.get('type'), e)
+            try:
+                self.backend.flush()
+            except Exception as e:
+                log.warning("Error flushing input: %s", e)
+            self.on_applied(len(records))
+
+            if self.stats is not None:
+                self.stats.record('inject', time.time() - start)
+                self.stats.count('inputs_injected', len(injected))
+                self.stats.count('inputs_coalesced', len(records) - len(injected))
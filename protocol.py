@@ -0,0 +1,212 @@
+import json
+import struct
+
+from framing import send_message
+
+# First byte of every message payload
+MSG_CONTROL = 0x01  # JSON object: handshake, screen_info, connection_status
+MSG_FRAME = 0x02  # Tile frame
+MSG_FRAME_ACK = 0x03  # Controller displayed a frame
+MSG_KEYFRAME_REQUEST = 0x04  # Relay or controller needs a full frame
+MSG_VIDEO = 0x05  # Video codec packet, the codec is named in screen_info
+MSG_FRAGMENT = 0x06  # Datagram carrying part of a tile or video frame
+MSG_UDP_HELLO = 0x07  # Datagram registering a client's UDP address with the relay, echoed back
+MSG_CURSOR_POSITION = 0x08  # Pointer position on the controlled screen
+MSG_CURSOR_SHAPE = 0x09  # Pointer image, sent once per shape ID
+MSG_INPUT_ACK = 0x0A  # Relay passed a controller's input write on to the controlled client
+MSG_MOVE = 0x10  # Mouse move
+MSG_CLICK = 0x11  # Mouse button
+MSG_KEY = 0x12  # Keyboard key
+MSG_BATCH = 0x13  # Several input records sent in one write
+
+# Tile frame: header, an optional copy rectangle, optional tile cache references, then (rect, JPEG) pairs
+# The capture time (microseconds since the epoch) and the number of input records applied
+# before the capture let the controller measure end-to-end and input round-trip latency;
+# records are counted per input connection, the relay's INPUT_ACKs place each write in that count
+FRAME_HEADER = struct.Struct(">BBIQIHHH")  # type, flags, sequence, capture time, inputs applied, width, height, rect count
+FRAME_RECT = struct.Struct(">HHHHL")  # x, y, width, height, JPEG size
+FLAG_KEYFRAME = 0x01
+FLAG_COPY = 0x02  # A COPY_RECT follows the header, applied to the previous picture before the tiles
+COPY_RECT = struct.Struct(">HHHHHH")  # x, y, width, height, source x, source y
+FLAG_CACHED = 0x04  # CACHE_REFS follows, each reference pastes a tile from the viewer's tile cache
+CACHE_REFS = struct.Struct(">H")  # reference count
+CACHE_REF = struct.Struct(">HHI")  # x, y, tile ID
+FLAG_CACHE_RESET = 0x08  # Keyframe that empties the tile caches, sent to resynchronize viewers
+
+# Video frame: header followed by one encoded packet
+VIDEO_HEADER = struct.Struct(">BBIQIHH")  # type, flags, sequence, capture time, inputs applied, width, height
+
+# Datagram transport: frames are split into fragments, each a datagram of its own
+FRAGMENT = struct.Struct(">BIIHH")  # type, token, frame sequence, fragment index, fragment count
+UDP_HELLO = struct.Struct(">BI")  # type, token
+
+# Cursor: positions are fractions of CURSOR_SCALE of the captured region, shapes are PNG images
+CURSOR_POSITION = struct.Struct(">BHHIB")  # type, x, y, shape ID, visible
+CURSOR_SHAPE = struct.Struct(">BIHH")  # type, shape ID, hotspot x, hotspot y; followed by the PNG image
+CURSOR_SCALE = 65535
+
+FRAME_ACK = struct.Struct(">BI")  # type, sequence
+INPUT_ACK = struct.Struct(">BII")  # type, writes received from this controller, records sent to the controlled client
+MOVE = struct.Struct(">BHH")  # type, x, y as fractions of MOVE_SCALE
+CLICK = struct.Struct(">BBB")  # type, button, pressed
+KEY = struct.Struct(">BB")  # type, pressed; followed by the UTF-8 key name
+BATCH = struct.Struct(">BH")  # type, record count; each record is prefixed with BATCH_RECORD
+BATCH_RECORD = struct.Struct(">B")  # record length
+
+MOVE_SCALE = 65535
+BUTTONS = {'left': 1, 'middle': 2, 'right': 3}
+BUTTON_NAMES = {code: name for name, code in BUTTONS.items()}
+
+
+def message_type(data):
+    return data[0] if len(data) else None
+
+
+def encode_control(key_data):
+    return bytes([MSG_CONTROL]) + json.dumps(key_data).encode()
+
+
+def decode_control(data):
+    return json.loads(str(data[1:], 'utf-8'))
+
+
+def sendmsg(sock, key_data):
+    """Send a JSON control message"""
+    send_message(sock, encode_control(key_data))
+
+
+def is_screen_frame(data):
+    return message_type(data) in (MSG_FRAME, MSG_VIDEO)
+
+
+def is_keyframe(data):
+    return is_screen_frame(data) and bool(data[1] & FLAG_KEYFRAME)
+
+
+def frame_seq(data):
+    # Tile and video frames share the type, flags, sequence... prefix
+    return VIDEO_HEADER.unpack_from(data)[2]
+
+
+def frame_info(data):
+    """Return (sequence, capture time in seconds, inputs applied, width, height) of a screen frame"""
+    _, _, seq, capture_time, inputs_applied, width, height = VIDEO_HEADER.unpack_from(data)
+    return seq, capture_time / 1e6, inputs_applied, width, height
+
+
+def pack_capture_time(capture_time):
+    return int(capture_time * 1e6)
+
+
+def encode_frame_ack(seq):
+    return FRAME_ACK.pack(MSG_FRAME_ACK, seq)
+
+
+def decode_frame_ack(data):
+    return FRAME_ACK.unpack_from(data)[1]
+
+
+def encode_input_ack(writes, records):
+    return INPUT_ACK.pack(MSG_INPUT_ACK, writes, records & 0xFFFFFFFF)
+
+
+def decode_input_ack(data):
+    """Return (writes received from this controller, input records sent to the controlled client)"""
+    return INPUT_ACK.unpack_from(data)[1:]
+
+
+def input_record_count(data):
+    """Number of input records in one input write"""
+    if message_type(data) == MSG_BATCH:
+        return BATCH.unpack_from(data)[1]
+    return 1
+
+
+def encode_keyframe_request():
+    return bytes([MSG_KEYFRAME_REQUEST])
+
+
+def encode_cursor_position(x, y, shape_id, visible):
+    """Encode a normalized (0.0-1.0) pointer position within the captured region"""
+    return CURSOR_POSITION.pack(MSG_CURSOR_POSITION,
+                                int(min(max(x, 0.0), 1.0) * CURSOR_SCALE),
+                                int(min(max(y, 0.0), 1.0) * CURSOR_SCALE),
+                                shape_id, int(visible))
+
+
+def decode_cursor_position(data):
+    """Return (x, y, shape ID, visible)"""
+    _, x, y, shape_id, visible = CURSOR_POSITION.unpack_from(data)
+    return x / CURSOR_SCALE, y / CURSOR_SCALE, shape_id, bool(visible)
+
+
+def encode_cursor_shape(shape_id, hotspot_x, hotspot_y, png):
+    return CURSOR_SHAPE.pack(MSG_CURSOR_SHAPE, shape_id, hotspot_x, hotspot_y) + png
+
+
+def decode_cursor_shape(data):
+    """Return (shape ID, hotspot x, hotspot y, PNG image)"""
+    _, shape_id, hotspot_x, hotspot_y = CURSOR_SHAPE.unpack_from(data)
+    return shape_id, hotspot_x, hotspot_y, bytes(data[CURSOR_SHAPE.size:])
+
+
+def encode_udp_hello(token):
+    return UDP_HELLO.pack(MSG_UDP_HELLO, token)
+
+
+def decode_datagram_token(data):
+    """Token of a fragment or hello datagram"""
+    return UDP_HELLO.unpack_from(data)[1]
+
+
+def encode_move(x, y):
+    """Encode a normalized (0.0-1.0) pointer position"""
+    return MOVE.pack(MSG_MOVE,
+                     int(min(max(x, 0.0), 1.0) * MOVE_SCALE),
+                     int(min(max(y, 0.0), 1.0) * MOVE_SCALE))
+
+
+def encode_click(button, pressed):
+    return CLICK.pack(MSG_CLICK, BUTTONS[button], int(pressed))
+
+
+def encode_key(event_type, key):
+    return KEY.pack(MSG_KEY, int(event_type == 'press')) + key.encode()
+
+
+def encode_batch(records):
+    parts = [BATCH.pack(MSG_BATCH, len(records))]
+    for record in records:
+        parts.append(BATCH_RECORD.pack(len(record)))
+        parts.append(record)
+    return b''.join(parts)
+
+
+def decode_batch(data):
+    """Return the input records of a batch in the order they were generated"""
+    _, count = BATCH.unpack_from(data)
+    offset = BATCH.size
+    records = []
+    for _ in range(count):
+        size = BATCH_RECORD.unpack_from(data, offset)[0]
+        offset += BATCH_RECORD.size
+        records.append(data[offset:offset + size])
+        offset += size
+    return records
+
+
+def decode_input(data):
+    """Decode an input record into the dict form the controlled client's handlers take"""
+    kind = message_type(data)
+    if kind == MSG_MOVE:
+        _, x, y = MOVE.unpack_from(data)
+        return {'type': 'move', 'x': x / MOVE_SCALE, 'y': y / MOVE_SCALE}
+    if kind == MSG_CLICK:
+        _, button, pressed = CLICK.unpack_from(data)
+        return {'type': 'click', 'button': BUTTON_NAMES.get(button),
+                'action': 'press' if pressed else 'release'}
+    if kind == MSG_KEY:
+        _, pressed = KEY.unpack_from(data)
+        return {'type': 'press' if pressed else 'release',
+                'key': str(data[KEY.size:], 'utf-8')}
+    return None
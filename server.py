@@ -1,208 +1,579 @@
-import socket
-import threading
-import struct
+import asyncio
+import collections
 import json
+import random
+import struct
+import threading
+import time
 import os
 
+import protocol
+import stats
+from connection import configure_datagram_socket, configure_socket, get_send_backlog
+from datagram import Reassembler, fragment
+from framing import HEADER, MessageAssembler
+
 # Server configuration - configurable via environment variables
 HOST = os.getenv('SERVER_HOST', '0.0.0.0')  # Listen on all interfaces
 SCREEN_PORT = int(os.getenv('SCREEN_PORT', '12345'))
 INPUT_PORT = int(os.getenv('INPUT_PORT', '12346'))
+SCREEN_UDP_PORT = int(os.getenv('SCREEN_UDP_PORT', '12347'))  # Datagram screen transport
+DEFAULT_SESSION = 'default'  # Used by clients that send the bare client type handshake
+
+# Where each client type's messages are forwarded to
+ROUTES = {
+    'controlled_screen': 'controller_screen',  # Screen frames
+    'controller_screen': 'controlled_screen',  # Frame acknowledgements
+    'controller_input': 'controlled_input',  # Keyboard and mouse events
+}
+CLIENT_TYPES = ('controlled_screen', 'controller_screen', 'controlled_input', 'controller_input')
+MULTI_PEER_TYPES = ('controller_screen', 'controller_input')  # Any number of viewers may join a session
+DATAGRAM_TYPES = ('controlled_screen', 'controller_screen')  # Client types that may move frames to UDP
+FRAME_QUEUE_SIZE = int(os.getenv('FRAME_QUEUE_SIZE', '3'))  # Screen frames buffered per viewer
+CURSOR_SHAPE_CACHE = 32  # Cursor shapes kept per session for viewers that join later
+
+relay_stats = stats.Stats('relay')
+LATEST_CURSOR_POSITION = object()  # Outbox placeholder for a peer's pending cursor position
+
+
+class Peer:
+    """A connected client with its own outbound queue, so a slow socket only delays itself"""
+
+    def __init__(self, client_type, protocol):
+        self.client_type = client_type
+        self.protocol = protocol
+        self.outbox = collections.deque()  # (data, is_frame, enqueue time)
+        self.outbox_ready = asyncio.Event()
+        self.queued_frames = 0
+        self.waiting_for_keyframe = False
+        self.dropped_frames = 0
+        self.token = None  # Identifies this peer's datagrams when it asked for the UDP transport
+        self.udp_address = None  # Set once a hello from the peer's UDP socket got through
+        self.display_size = None  # (width, height) a viewer can show, from its viewer_size messages
+        self.cursor_position = None  # Latest cursor position not yet written, queued as LATEST_CURSOR_POSITION
+        self.inputs_received = 0  # Input writes read from a controller, numbered in its INPUT_ACKs
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    def send(self, data, is_frame=False):
+        """Queue a message without waiting for the socket"""
+        self.outbox.append((data, is_frame, time.time()))
+        if is_frame:
+            self.queued_frames += 1
+        relay_stats.gauge(f"{self.client_type}_queue_depth", len(self.outbox))
+        self.outbox_ready.set()
+
+    def sendmsg(self, key_data):
+        self.send(protocol.encode_control(key_data))
+
+    def send_cursor_position(self, data):
+        """Queue a cursor position; one still waiting behind frames is replaced, only the latest matters"""
+        if self.cursor_position is not None:
+            relay_stats.count('cursor_positions_coalesced')
+            self.cursor_position = data
+            return
+        self.cursor_position = data
+        self.send(LATEST_CURSOR_POSITION)
+
+    def send_frame(self, data, keyframe):
+        """
+        Queue a screen frame unless this viewer is too far behind
+        Returns False when the viewer just fell behind and needs a new keyframe
+        """
+        if keyframe and self.queued_frames:
+            # A keyframe replaces everything still queued, which is stale by now
+            self.dropped_frames += self.queued_frames
+            relay_stats.count('frames_dropped', self.queued_frames)
+            self.outbox = collections.deque(entry for entry in self.outbox if not entry[1])
+            self.queued_frames = 0
+
+        if keyframe:
+            self.waiting_for_keyframe = False
+        elif self.waiting_for_keyframe:
+            # Deltas cannot be applied after a gap
+            self.dropped_frames += 1
+            relay_stats.count('frames_dropped')
+            return True
+        elif self.queued_frames >= FRAME_QUEUE_SIZE:
+            self.dropped_frames += 1
+            relay_stats.count('frames_dropped')
+            self.waiting_for_keyframe = True
+            return False
+
+        self.send(data, is_frame=True)
+        return True
+
+    def queue_status(self):
+        """Outbound queue figures for this peer; only screen frames are ever dropped"""
+        return {
+            'client_type': self.client_type,
+            'transport': 'tcp' if self.udp_address is None else 'udp',
+            'queued_messages': len(self.outbox),
+            'queued_frames': self.queued_frames,
+            'dropped_frames': self.dropped_frames,
+            'waiting_for_keyframe': self.waiting_for_keyframe,
+        }
 
-screen_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-input_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-screen_server.bind((HOST, SCREEN_PORT))
-input_server.bind((HOST, INPUT_PORT))
-
-screen_server.listen(2)
-input_server.listen(2)
-
-controlled_screen = None
-controller_screen = None
-controlled_input = None
-controller_input = None
-
-client_lock = threading.Lock()
-
-
-def sendmsg(socket, key_data):
-    data = json.dumps(key_data).encode()
-    size = len(data)
-    socket.sendall(struct.pack(">L", size) + data)
-
-
-def recvmsg(socket):
-    size_data = recvall(socket, 4)
-    if not size_data:
-        return None
-    size = struct.unpack(">L", size_data)[0]
-    data = recvall(socket, size)
-    key_data = json.loads(data.decode())
-    return key_data
-
-
-def recvall(sock, size):
-    data = b''
-    while len(data) < size:
-        packet = sock.recv(min(size - len(data), 4096))
-        if not packet:
-            return None
-        data += packet
-    return data
-
-
-def handle_client_packets(client_socket, address):
-    global controlled_screen, controller_screen, controlled_input, controller_input
-
-    client_type = recvmsg(client_socket)
-    print(f"Connection from {address} as {client_type}")
-
-    with client_lock:
-        if client_type == 'controlled_screen':
-            controlled_screen = client_socket
-            print("Controlled screen connected")
-        elif client_type == 'controller_screen':
-            controller_screen = client_socket
-            print("Controller screen connected")
-        elif client_type == 'controlled_input':
-            controlled_input = client_socket
-            print("Controlled input connected")
-        elif client_type == 'controller_input':
-            controller_input = client_socket
-            print("Controller input connected")
-
-        check_and_notify_connection()
-
-    try:
-        while True:
-            size_data = recvall(client_socket, 4)
-            if not size_data:
-                break
-
-            size = struct.unpack(">L", size_data)[0]
-            data = recvall(client_socket, size)
-
-            if not data:
-                break
-
-            with client_lock:
-                if client_type == 'controlled_screen' and controller_screen:
-                    try:
-                        controller_screen.sendall(size_data + data)
-                    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
-                        print("Controller screen disconnected while sending data")
-                        controller_screen = None
-                        break
-                elif client_type == 'controller_input' and controlled_input:
-                    try:
-                        controlled_input.sendall(size_data + data)
-                    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
-                        print("Controlled input disconnected while sending data")
-                        controlled_input = None
-                        break
-    except Exception as e:
-        print(f"Error handling client {client_type}: {e}")
-    finally:
-        with client_lock:
-            if client_type == 'controlled_screen' and controlled_screen == client_socket:
-                controlled_screen = None
-                print("Controlled screen disconnected")
-            elif client_type == 'controller_screen' and controller_screen == client_socket:
-                controller_screen = None
-                print("Controller screen disconnected")
-            elif client_type == 'controlled_input' and controlled_input == client_socket:
-                controlled_input = None
-                print("Controlled input disconnected")
-            elif client_type == 'controller_input' and controller_input == client_socket:
-                controller_input = None
-                print("Controller input disconnected")
-
+    async def write_loop(self):
+        transport = self.protocol.transport
+        while not transport.is_closing():
+            if not self.outbox:
+                self.outbox_ready.clear()
+                await self.outbox_ready.wait()
+                continue
+            data, is_frame, enqueue_time = self.outbox.popleft()
+            if data is LATEST_CURSOR_POSITION:
+                data, self.cursor_position = self.cursor_position, None
+            if is_frame:
+                self.queued_frames -= 1
+                relay_stats.record('frame_queue', time.time() - enqueue_time)
+                relay_stats.count('frames_forwarded')
+                relay_stats.count('bytes_forwarded', len(data))
+            # Scatter/gather write on Python 3.12+, so the frame is not copied per viewer
+            transport.writelines([HEADER.pack(len(data)), data])
+            self.record_buffers()
+            await self.protocol.can_write.wait()
+
+    def record_buffers(self):
+        """Track how full this peer's buffers are, so a filling pipe shows up before frames drop"""
+        buffered = self.protocol.transport.get_write_buffer_size()
+        relay_stats.gauge(f"{self.client_type}_write_buffer", buffered)
+        backlog = get_send_backlog(self.protocol.transport.get_extra_info('socket'))
+        if backlog is not None:
+            relay_stats.gauge(f"{self.client_type}_send_backlog", backlog)
+
+    def send_datagrams(self, datagrams):
+        for datagram in datagrams:
+            datagram_transport.sendto(datagram, self.udp_address)
+        relay_stats.count('datagrams_forwarded', len(datagrams))
+
+    def close(self):
+        self.writer_task.cancel()
+        self.protocol.transport.close()
+
+
+class Session:
+    """Routing table for one controlled client and the controllers watching it"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.peers = {}  # client type -> list of Peers
+        self.screen_info = None  # Latest screen_info message, replayed to viewers that join later
+        self.active = False
+        self.reassembler = Reassembler()  # Rebuilds datagram frames for viewers still on TCP
+        # The controlled client sends each cursor shape once, so the relay keeps them for late joiners
+        self.cursor_shapes = collections.OrderedDict()  # shape ID -> cursor shape message
+        self.cursor_position = None  # Latest cursor position message
+        self.inputs_forwarded = 0  # Input records sent to the current controlled_input peer
+
+    def add(self, peer):
+        peers = self.peers.setdefault(peer.client_type, [])
+        if peer.client_type not in MULTI_PEER_TYPES:
+            for previous in peers:
+                previous.close()
+            peers.clear()
+        peers.append(peer)
+
+        if peer.client_type == 'controller_screen':
+            if self.screen_info:
+                peer.send(self.screen_info)
+            for shape in self.cursor_shapes.values():
+                peer.send(shape)
+            if self.cursor_position:
+                peer.send_cursor_position(self.cursor_position)
+            # Give the new viewer a full picture without waiting for the periodic keyframe
+            self.request_keyframe()
+        elif peer.client_type == 'controlled_input':
+            # The controlled client counts the input records of each connection from zero
+            self.inputs_forwarded = 0
+        elif peer.client_type == 'controlled_screen':
+            # A new controlled client numbers its frames from zero again
+            self.reassembler = Reassembler()
+            # Viewers usually report their size before the controlled client joins
+            self.send_viewer_size()
+
+        self.check_and_notify_connection(peer)
+
+    def remove(self, peer):
+        peers = self.peers.get(peer.client_type, [])
+        if peer not in peers:
+            return False
+        peers.remove(peer)
+        if not peers:
+            del self.peers[peer.client_type]
+            self.active = False
+        if peer.client_type == 'controller_screen' and peer.display_size:
+            self.send_viewer_size()
+        return True
+
+    def forward(self, peer, data):
+        targets = self.peers.get(ROUTES.get(peer.client_type), [])
+
+        if peer.client_type == 'controlled_screen':
+            if protocol.is_screen_frame(data):
+                self.forward_frame(data, targets)
+                return
+            if protocol.message_type(data) == protocol.MSG_CONTROL:
+                self.remember_screen_info(data)
+            elif protocol.message_type(data) == protocol.MSG_CURSOR_SHAPE:
+                self.remember_cursor_shape(data)
+            elif protocol.message_type(data) == protocol.MSG_CURSOR_POSITION:
+                self.cursor_position = data
+                for target in targets:
+                    target.send_cursor_position(data)
+                return
+        elif peer.client_type == 'controller_screen' and protocol.message_type(data) == protocol.MSG_CONTROL:
+            if self.update_viewer_size(peer, data):
+                return
+        elif peer.client_type == 'controller_input':
+            self.forward_input(peer, data, targets)
+            return
+
+        for target in targets:
+            target.send(data)
+
+    def forward_frame(self, data, targets, datagrams=None):
+        """Send a complete screen frame to every viewer over the transport that viewer uses"""
+        keyframe = protocol.is_keyframe(data)
+
+        # Every TCP viewer gets the same buffer; each one drops frames on its own
+        tcp_viewers = [viewer for viewer in targets if viewer.udp_address is None]
+        if not all([viewer.send_frame(data, keyframe) for viewer in tcp_viewers]):
+            self.request_keyframe()
+
+        udp_viewers = [viewer for viewer in targets if viewer.udp_address is not None]
+        if udp_viewers and datagrams is None:
+            datagrams = fragment(data, 0, protocol.frame_seq(data))
+        for viewer in udp_viewers:
+            viewer.send_datagrams(datagrams)
+
+    def forward_input(self, peer, data, targets):
+        """
+        Pass an input write on to the controlled client and tell the controller where it landed
+        Frames carry the number of records the controlled client has handled, which counts every
+        controller's input; the acknowledgement lets each controller find its own writes in it
+        """
+        peer.inputs_received += 1
+        if not targets:
+            return  # Nothing to deliver it to; the controller gives up on writes that are never acknowledged
         try:
-            client_socket.close()
-        except:
-            pass
-
+            self.inputs_forwarded += protocol.input_record_count(data)
+        except struct.error:
+            pass  # Malformed batch, which the controlled client does not count either
+        for target in targets:
+            target.send(data)
+        peer.send(protocol.encode_input_ack(peer.inputs_received, self.inputs_forwarded))
+
+    def forward_datagram(self, data):
+        """Route a frame fragment from the controlled client"""
+        targets = self.peers.get('controller_screen', [])
+        # UDP viewers get every fragment as soon as it arrives, without waiting for the whole frame
+        for viewer in targets:
+            if viewer.udp_address is not None:
+                viewer.send_datagrams([data])
+
+        tcp_viewers = [viewer for viewer in targets if viewer.udp_address is None]
+        if not tcp_viewers:
+            return
+        result = self.reassembler.add(data)
+        if result is None:
+            return
+        frame, skipped = result
+        keyframe = protocol.is_keyframe(frame)
+        if skipped and not keyframe:
+            # Frames were lost on the way in, deltas cannot be applied until the next keyframe
+            relay_stats.count('datagram_frames_lost', skipped)
+            for viewer in tcp_viewers:
+                viewer.waiting_for_keyframe = True
+            self.request_keyframe()
+        # As in forward_frame, a viewer whose queue just overflowed needs a keyframe to catch up
+        if not all([viewer.send_frame(frame, keyframe) for viewer in tcp_viewers]):
+            self.request_keyframe()
+
+    def remember_screen_info(self, data):
+        try:
+            message = protocol.decode_control(data)
+        except (ValueError, UnicodeDecodeError):
+            return
+        if isinstance(message, dict) and message.get('type') == 'screen_info':
+            self.screen_info = data
 
-def check_and_notify_connection():
-    if controlled_screen and controller_screen and controlled_input and controller_input:
-        print("All connections established! Remote control session is active.")
+    def remember_cursor_shape(self, data):
+        try:
+            shape_id = protocol.decode_cursor_shape(data)[0]
+        except struct.error:
+            return
+        self.cursor_shapes[shape_id] = data
+        self.cursor_shapes.move_to_end(shape_id)
+        while len(self.cursor_shapes) > CURSOR_SHAPE_CACHE:
+            self.cursor_shapes.popitem(last=False)
+
+    def update_viewer_size(self, peer, data):
+        """Record a viewer's display size; returns False for any other control message"""
+        try:
+            message = protocol.decode_control(data)
+        except (ValueError, UnicodeDecodeError):
+            return False
+        if not isinstance(message, dict) or message.get('type') != 'viewer_size':
+            return False
+        try:
+            peer.display_size = (int(message['width']), int(message['height']))
+        except (KeyError, TypeError, ValueError):
+            peer.display_size = None
+        self.send_viewer_size()
+        return True
+
+    def send_viewer_size(self):
+        """
+        Tell the controlled client the largest area any viewer can show, so it never encodes
+        more pixels than that; without a size from every viewer it keeps the native resolution
+        """
+        viewers = self.peers.get('controller_screen', [])
+        message = {'type': 'viewer_size'}
+        if viewers and all(viewer.display_size for viewer in viewers):
+            message['width'] = max(viewer.display_size[0] for viewer in viewers)
+            message['height'] = max(viewer.display_size[1] for viewer in viewers)
+        for target in self.peers.get('controlled_screen', []):
+            target.sendmsg(message)
+
+    def request_keyframe(self):
+        for peer in self.peers.get('controlled_screen', []):
+            peer.send(protocol.encode_keyframe_request())
+
+    def check_and_notify_connection(self, peer):
         notification = {
             'type': 'connection_status',
             'status': 'complete'
         }
+        if self.active:
+            # Session is already running, only the newcomer needs to know
+            peer.sendmsg(notification)
+        elif all(client_type in self.peers for client_type in CLIENT_TYPES):
+            print(f"[{self.session_id}] All connections established! Remote control session is active.")
+            self.active = True
+            for peers in self.peers.values():
+                for other in peers:
+                    other.sendmsg(notification)
+
+    def close(self):
+        for peers in list(self.peers.values()):
+            for peer in peers:
+                peer.close()
+        self.peers.clear()
+
+
+sessions = {}  # session ID -> Session
+connections = set()  # Open RelayProtocols, so shutdown can close every connection
+
+
+def get_session(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        session = sessions[session_id] = Session(session_id)
+    return session
+
+
+def release_session(session):
+    if not session.peers and sessions.get(session.session_id) is session:
+        del sessions[session.session_id]
+
+
+def queue_report():
+    """Per-peer queue depth and drop counts for every session"""
+    return {session_id: [peer.queue_status() for peers in session.peers.values() for peer in peers]
+            for session_id, session in sessions.items()}
+
+
+def parse_handshake(handshake):
+    """Return (client type, session ID, screen transport) from either handshake form"""
+    if isinstance(handshake, dict):
+        client_type, session_id, transport = (handshake.get('client_type'),
+                                              str(handshake.get('session') or DEFAULT_SESSION),
+                                              handshake.get('transport', 'tcp'))
+    else:
+        client_type, session_id, transport = handshake, DEFAULT_SESSION, 'tcp'
+    if client_type not in CLIENT_TYPES:
+        raise ValueError(f"unknown client type {client_type!r}")
+    return client_type, session_id, transport
+
+
+datagram_peers = {}  # token -> Peer using the UDP screen transport
+datagram_transport = None
+
+
+class DatagramRelayProtocol(asyncio.DatagramProtocol):
+    """
+    Screen frames over UDP: fragments from a controlled client are passed straight on to its
+    viewers, so one lost packet only costs the frame it belonged to instead of stalling the stream
+    """
+
+    def datagram_received(self, data, address):
+        kind = protocol.message_type(data)
+        if kind not in (protocol.MSG_FRAGMENT, protocol.MSG_UDP_HELLO) or len(data) < protocol.UDP_HELLO.size:
+            return
+        peer = datagram_peers.get(protocol.decode_datagram_token(data))
+        if peer is None:
+            return
+
+        if kind == protocol.MSG_UDP_HELLO:
+            if peer.udp_address != address:
+                print(f"[{peer.protocol.session.session_id}] {peer.client_type} screen frames over UDP from {address}")
+            peer.udp_address = address
+            datagram_transport.sendto(data, address)
+        elif peer.client_type == 'controlled_screen':
+            peer.udp_address = address
+            peer.protocol.session.forward_datagram(data)
+
+    def error_received(self, exc):
+        # Typically an ICMP port unreachable from a viewer that went away
+        relay_stats.count('datagram_errors')
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """
+    One client connection: the first message is the handshake, every later one is routed
+    Messages are received with recv_into straight into buffers the relay then forwards as is
+    """
+
+    def __init__(self, channel):
+        self.channel = channel  # 'screen' or 'input', decides the socket options
+        self.assembler = MessageAssembler(reuse_buffers=False)
+        self.transport = None
+        self.address = None
+        self.peer = None
+        self.session = None
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        configure_socket(transport.get_extra_info('socket'), self.channel)
+        connections.add(self)
+
+    def get_buffer(self, sizehint):
+        return self.assembler.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        for data in self.assembler.buffer_updated(nbytes):
+            if self.peer is None:
+                self.handshake(data)
+            else:
+                self.session.forward(self.peer, data)
+
+    def handshake(self, data):
+        try:
+            if protocol.message_type(data) != protocol.MSG_CONTROL:
+                raise ValueError("expected a control message")
+            client_type, session_id, transport = parse_handshake(protocol.decode_control(data))
+        except (ValueError, UnicodeDecodeError) as e:
+            print(f"Invalid handshake from {self.address}: {e}")
+            self.transport.close()
+            return
+        print(f"Connection from {self.address} as {client_type} in session {session_id}")
+
+        self.peer = Peer(client_type, self)
+        self.session = get_session(session_id)
+        self.session.add(self.peer)
+        print(f"[{session_id}] {client_type.replace('_', ' ').capitalize()} connected")
+
+        if transport == 'udp' and client_type in DATAGRAM_TYPES and datagram_transport is not None:
+            # The client registers its UDP socket with this token; frames stay on TCP until it does
+            self.peer.token = random.getrandbits(32)
+            while self.peer.token in datagram_peers:
+                self.peer.token = random.getrandbits(32)
+            datagram_peers[self.peer.token] = self.peer
+            self.peer.sendmsg({'type': 'udp_setup', 'token': self.peer.token, 'port': SCREEN_UDP_PORT})
+
+    def pause_writing(self):
+        self.can_write.clear()
+        if self.peer:
+            relay_stats.count(f"{self.peer.client_type}_write_pauses")
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    def connection_lost(self, exc):
+        connections.discard(self)
+        self.can_write.set()
+        if self.peer:
+            if self.session.remove(self.peer):
+                print(f"[{self.session.session_id}] {self.peer.client_type.replace('_', ' ').capitalize()} disconnected")
+                release_session(self.session)
+            self.peer.writer_task.cancel()
+            if self.peer.token is not None:
+                datagram_peers.pop(self.peer.token, None)
+
+
+async def wait_for_quit():
+    """Read commands on a daemon thread so a pending input() never blocks shutdown"""
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def read_commands():
         try:
-            sendmsg(controlled_screen, notification)
-            sendmsg(controller_screen, notification)
-            sendmsg(controlled_input, notification)
-            sendmsg(controller_input, notification)
+            while True:
+                command = input("Type 'stats' for relay statistics or 'quit' to stop the server: ")
+                if command.lower() == 'quit':
+                    break
+                if command.lower() == 'stats':
+                    print(json.dumps(dict(relay_stats.snapshot(), queues=queue_report()), indent=2))
+            loop.call_soon_threadsafe(done.set_result, None)
         except Exception as e:
-            print(f"Error notifying clients: {e}")
+            loop.call_soon_threadsafe(done.set_exception, e)
+
+    threading.Thread(target=read_commands, daemon=True).start()
+    await done
 
 
-def accept_screen_connections():
+async def dump_stats():
     while True:
-        try:
-            client_socket, addr = screen_server.accept()
-            thread = threading.Thread(target=handle_client_packets, args=(client_socket, addr))
-            thread.daemon = True
-            thread.start()
-        except Exception as e:
-            print(f"Error accepting screen connection: {e}")
-            if screen_server.fileno() == -1:  # Socket closed
-                break
+        await asyncio.sleep(stats.STATS_INTERVAL)
+        relay_stats.dump(extra={'queues': queue_report()})
 
 
-def accept_input_connections():
-    while True:
-        try:
-            client_socket, addr = input_server.accept()
-            thread = threading.Thread(target=handle_client_packets, args=(client_socket, addr))
-            thread.daemon = True
-            thread.start()
-        except Exception as e:
-            print(f"Error accepting input connection: {e}")
-            if input_server.fileno() == -1:  # Socket closed
-                break
+async def serve():
+    global datagram_transport
+
+    loop = asyncio.get_running_loop()
+    screen_server = await loop.create_server(lambda: RelayProtocol('screen'), HOST, SCREEN_PORT)
+    input_server = await loop.create_server(lambda: RelayProtocol('input'), HOST, INPUT_PORT)
+    try:
+        datagram_transport, _ = await loop.create_datagram_endpoint(DatagramRelayProtocol,
+                                                                    local_addr=(HOST, SCREEN_UDP_PORT))
+        configure_datagram_socket(datagram_transport.get_extra_info('socket'))
+        print(f"Screen frames over UDP accepted on {HOST}:{SCREEN_UDP_PORT}")
+    except OSError as e:
+        print(f"UDP screen transport disabled: {e}")
 
+    dump_task = asyncio.create_task(dump_stats())
 
-def main():
     try:
         print(f"Server listening on {HOST}:{SCREEN_PORT} for screen and {HOST}:{INPUT_PORT} for input")
         print("Use Ctrl+C to stop the server")
+        await wait_for_quit()
+    finally:
+        screen_server.close()
+        input_server.close()
+        if datagram_transport is not None:
+            datagram_transport.close()
+        dump_task.cancel()
+        relay_stats.dump(extra={'queues': queue_report()})
 
-        screen_thread = threading.Thread(target=accept_screen_connections)
-        input_thread = threading.Thread(target=accept_input_connections)
-
-        screen_thread.daemon = True
-        input_thread.daemon = True
+        for relay in list(connections):
+            relay.transport.close()
+        for session in list(sessions.values()):
+            session.close()
+        sessions.clear()
 
-        screen_thread.start()
-        input_thread.start()
 
-        while True:
-            command = input("Type 'quit' to stop the server: ")
-            if command.lower() == 'quit':
-                break
+def main():
+    try:
+        asyncio.run(serve())
     except KeyboardInterrupt:
         print("\nServer shutting down...")
     except Exception as e:
         print(f"Server error: {e}")
     finally:
-        with client_lock:
-            for client in [controlled_screen, controller_screen, controlled_input, controller_input]:
-                if client:
-                    try:
-                        client.close()
-                    except:
-                        pass
-
-        try:
-            screen_server.close()
-            input_server.close()
-        except:
-            pass
-
         print("Server shut down successfully")
 
 
@@ -0,0 +1,135 @@
+import collections
+import json
+import math
+import os
+import threading
+import time
+
+# Statistics configuration - configurable via environment variables
+STATS_WINDOW = float(os.getenv('STATS_WINDOW', '10'))  # Seconds of history behind every figure
+STATS_DIR = os.getenv('STATS_DIR')  # Directory each process writes <name>.json into, if set
+STATS_INTERVAL = float(os.getenv('STATS_INTERVAL', '2'))  # Seconds between JSON dumps
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = math.ceil(pct / 100.0 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+class Stats:
+    """
+    Rolling per-stage timings and event counters over the last STATS_WINDOW seconds
+    Stages are durations in seconds (reported as p50/p95/p99 milliseconds); counters are
+    events such as frames or bytes, reported as per-second rates plus running totals; gauges
+    are levels such as buffer fill, reported as the last and the peak value
+    Safe to update from several threads
+    """
+
+    def __init__(self, name, window=STATS_WINDOW):
+        self.name = name
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(collections.deque)  # stage -> (time, seconds)
+        self.events = collections.defaultdict(collections.deque)  # counter -> (time, amount)
+        self.levels = collections.defaultdict(collections.deque)  # gauge -> (time, value)
+        self.totals = collections.Counter()
+        self.started = time.time()
+        self.last_dump = 0.0
+
+    def record(self, stage, seconds):
+        now = time.time()
+        with self.lock:
+            samples = self.samples[stage]
+            samples.append((now, seconds))
+            self.prune(samples, now)
+
+    def count(self, counter, amount=1):
+        now = time.time()
+        with self.lock:
+            events = self.events[counter]
+            events.append((now, amount))
+            self.totals[counter] += amount
+            self.prune(events, now)
+
+    def gauge(self, name, value):
+        now = time.time()
+        with self.lock:
+            levels = self.levels[name]
+            levels.append((now, value))
+            self.prune(levels, now)
+
+    def prune(self, entries, now):
+        while entries and now - entries[0][0] > self.window:
+            entries.popleft()
+
+    def snapshot(self):
+        """Return the current figures as a JSON-serializable dict"""
+        now = time.time()
+        # Rates are averaged over the window, or over the uptime while that is shorter
+        span = max(min(self.window, now - self.started), 1e-3)
+        with self.lock:
+            stages = {}
+            for stage, samples in self.samples.items():
+                self.prune(samples, now)
+                values = sorted(seconds for _, seconds in samples)
+                stages[stage] = {
+                    'count': len(values),
+                    'p50_ms': to_ms(percentile(values, 50)),
+                    'p95_ms': to_ms(percentile(values, 95)),
+                    'p99_ms': to_ms(percentile(values, 99)),
+                }
+            rates = {}
+            for counter, events in self.events.items():
+                self.prune(events, now)
+                rates[counter] = round(sum(amount for _, amount in events) / span, 2)
+            gauges = {}
+            for name, levels in self.levels.items():
+                self.prune(levels, now)
+                if levels:
+                    gauges[name] = {'last': levels[-1][1], 'max': max(value for _, value in levels)}
+            totals = dict(self.totals)
+        return {'name': self.name, 'time': now, 'window': self.window,
+                'stages': stages, 'rates': rates, 'totals': totals, 'gauges': gauges}
+
+    def summary_lines(self):
+        """Short human-readable lines, e.g. for an on-screen overlay"""
+        snapshot = self.snapshot()
+        lines = [f"{counter}: {rate:g}/s (total {snapshot['totals'].get(counter, 0)})"
+                 for counter, rate in sorted(snapshot['rates'].items())]
+        for stage, figures in sorted(snapshot['stages'].items()):
+            lines.append(f"{stage}: p50 {figures['p50_ms']} p95 {figures['p95_ms']} "
+                         f"p99 {figures['p99_ms']} ms")
+        for name, figures in sorted(snapshot['gauges'].items()):
+            lines.append(f"{name}: {figures['last']} (max {figures['max']})")
+        return lines
+
+    def dump(self, directory=STATS_DIR, extra=None):
+        """
+        Write the snapshot to <directory>/<name>.json, replacing the previous dump atomically
+        extra adds figures the caller tracks itself, e.g. the relay's per-viewer queues
+        """
+        if not directory:
+            return
+        path = os.path.join(directory, f"{self.name}.json")
+        snapshot = self.snapshot()
+        snapshot.update(extra or {})
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(snapshot, f, indent=2)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Error writing stats to {path}: {e}")
+
+    def maybe_dump(self):
+        """Dump at most every STATS_INTERVAL seconds; cheap enough to call from any loop"""
+        now = time.time()
+        if STATS_DIR and now - self.last_dump >= STATS_INTERVAL:
+            self.last_dump = now
+            self.dump()
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+
+import pytest
+
+import capture
+import controlled
+
+
+class FixedBitrate:
+    """AdaptiveBitrate stand-in with constant settings"""
+
+    def settings(self):
+        return controlled.QUALITY, 1.0, 50
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = capture.FakeCapture(640, 384)
+    monkeypatch.setattr(controlled, 'capture_region', dict(backend.monitors[1]))
+    monkeypatch.setattr(controlled, 'viewer_size', None)
+    monkeypatch.setattr(controlled, 'KEYFRAME_INTERVAL', 60.0)
+    return backend
+
+
+def start_capture(backend, capture_queue):
+    stop_event = threading.Event()
+    thread = threading.Thread(target=controlled.capture_frames,
+                              args=(capture_queue, stop_event, FixedBitrate(), backend, threading.Event()))
+    thread.daemon = True
+    thread.start()
+    return stop_event, thread
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_fake_capture_reports_exact_damage(backend):
+    region = backend.monitors[1]
+    backend.grab(region)
+    assert not backend.wait(0.01)
+
+    backend.paint(10, 20, 30, 40)
+    assert backend.wait(0.01)
+    frame, damage = backend.grab(region)
+    assert damage == [(10, 20, 30, 40)]
+    assert (frame[20:60, 10:40, :3] == 255).all()
+    assert backend.grab(region)[1] == []
+
+
+def test_fake_capture_clips_damage_to_region(backend):
+    backend.paint(600, 0, 100, 10)
+    _, damage = backend.grab({'left': 320, 'top': 0, 'width': 320, 'height': 384})
+    assert damage == [(280, 0, 40, 10)]
+
+
+def test_idle_screen_queues_no_frames(backend):
+    capture_queue = queue.Queue(maxsize=controlled.CAPTURE_QUEUE_SIZE)
+    stop_event, thread = start_capture(backend, capture_queue)
+    try:
+        # The first frame is a keyframe, then nothing is drawn
+        capture_queue.get(timeout=2.0)
+        time.sleep(0.5)
+        assert capture_queue.empty()
+
+        backend.paint(64, 64, 64, 64)
+        _, _, frame, damage = capture_queue.get(timeout=2.0)
+        assert damage == [(64, 64, 64, 64)]
+        assert frame.shape == (384, 640, 3)
+    finally:
+        stop_event.set()
+        thread.join(timeout=2.0)
+
+
+def test_dropped_frames_keep_their_damage(backend):
+    capture_queue = queue.Queue(maxsize=controlled.CAPTURE_QUEUE_SIZE)
+    stop_event, thread = start_capture(backend, capture_queue)
+    try:
+        _, _, first, _ = capture_queue.get(timeout=2.0)
+
+        # Nothing consumes the queue, so the oldest of these frames is dropped
+        for x, y in [(0, 0), (128, 0), (320, 192)]:
+            backend.paint(x, y, 64, 64)
+            wait_for(lambda: not backend.changed.is_set())
+            time.sleep(0.05)
+        assert capture_queue.full()
+
+        prev = first
+        changed = []
+        while not capture_queue.empty():
+            _, _, frame, damage = capture_queue.get_nowait()
+            changed += controlled.find_dirty_rects(prev, frame, damage=damage)
+            prev = frame
+        assert sorted(changed) == [(0, 0, 64, 64), (128, 0, 64, 64), (320, 192, 64, 64)]
+    finally:
+        stop_event.set()
+        thread.join(timeout=2.0)
+
+
+def test_merge_damage_without_damage_forces_full_compare():
+    dropped = (0.0, 0, None, None)
+    frame = (1.0, 0, None, [(0, 0, 8, 8)])
+    assert controlled.merge_damage(dropped, frame)[3] is None
@@ -0,0 +1,72 @@
+import collections
+
+
+def whole_tiles(rects, tile_size):
+    """Grid-aligned tiles lying entirely inside the rectangles, in the order both ends cache them"""
+    for x, y, w, h in rects:
+        for top in range(-(-y // tile_size) * tile_size, y + h - tile_size + 1, tile_size):
+            for left in range(-(-x // tile_size) * tile_size, x + w - tile_size + 1, tile_size):
+                yield left, top
+
+
+class TileCache:
+    """
+    LRU cache of recently sent tiles, kept by the controlled client (content hashes) and by
+    each viewer (decoded tiles)
+    Tiles are numbered in the order they are added, and both ends add, use and evict entries
+    in the same order with the same capacity, so a tile ID means the same tile on both ends
+    without evictions ever being sent. Keyframes flagged FLAG_CACHE_RESET empty both caches,
+    which is how a viewer that joined late or lost a frame gets back in step
+    """
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.reset()
+
+    def reset(self, capacity=None):
+        if capacity is not None:
+            self.capacity = capacity
+        self.tiles = collections.OrderedDict()  # tile ID -> (tile, content key), least recently used first
+        self.ids = {}  # content key -> tile ID, only used on the sending side
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, key):
+        """Return the ID of a cached tile with this content and mark it used, or None"""
+        tile_id = self.ids.get(key)
+        if tile_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tiles.move_to_end(tile_id)
+        return tile_id
+
+    def get(self, tile_id):
+        """Return a cached tile and mark it used, or None if the ID is unknown"""
+        entry = self.tiles.get(tile_id)
+        if entry is None:
+            return None
+        self.tiles.move_to_end(tile_id)
+        return entry[0]
+
+    def add(self, tile, key=None):
+        """Cache a tile under the next ID, evicting the least recently used one when full"""
+        if not self.capacity:
+            return
+        tile_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.tiles[tile_id] = (tile, key)
+        if key is not None:
+            self.ids[key] = tile_id
+        while len(self.tiles) > self.capacity:
+            evicted_id, (_, evicted_key) = self.tiles.popitem(last=False)
+            if evicted_key is not None and self.ids.get(evicted_key) == evicted_id:
+                del self.ids[evicted_key]